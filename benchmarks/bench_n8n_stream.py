@@ -0,0 +1,62 @@
+"""
+Measures the time to first token of the n8n Pipe, single-shot versus streaming,
+against a local stand-in for the n8n webhook.
+
+The stand-in produces the response in --chunks pieces, --delay seconds apart,
+and either streams them as n8n JSON lines or sends them all at the end.
+
+Usage: python benchmarks/bench_n8n_stream.py [--chunks 20] [--delay 0.05] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeN8n
+from pipelines.n8n import Pipe
+
+
+async def measure(pipe: Pipe, streaming: bool):
+    pipe.valves.enable_streaming = streaming
+    body = {"messages": [{"role": "user", "content": "hello"}], "stream": True}
+
+    start = time.perf_counter()
+    result = await pipe.pipe(body, __user__={"id": "bench"})
+    first = None
+    if isinstance(result, str):
+        first = time.perf_counter() - start
+    else:
+        async for chunk in result:
+            if first is None and chunk["choices"][0]["delta"].get("content"):
+                first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+async def run(base_url: str, runs: int):
+    pipe = Pipe()
+    for name, path, streaming in (("single-shot", "/single", False), ("streaming", "/stream", True)):
+        pipe.valves.n8n_url = base_url + path
+        samples = [await measure(pipe, streaming) for _ in range(runs)]
+        ttft = statistics.median(sample[0] for sample in samples)
+        total = statistics.median(sample[1] for sample in samples)
+        print(f"{name:<12} time to first token {ttft * 1000:8.1f} ms, total {total * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chunks", type=int, default=20)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with FakeN8n(chunks=args.chunks, delay=args.delay) as n8n:
+        asyncio.run(run(n8n.url, args.runs))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compares the full and compact function calling prompts on a fixed set of conversations:
+prompt size sent to the task model and end-to-end latency of Pipeline.inlet against a
+local stand-in for Ollama whose latency grows with the prompt size (prefill).
+
+Usage: python benchmarks/bench_prompt.py [--latency 0.1] [--prefill-per-1k-chars 0.02] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeOllama
+from pipelines.function_calling_filters_pipeline_custom import Pipeline
+
+INJECTED_CONTEXT = (
+    "Use the following context as your learned knowledge, inside <context></context> XML tags.\n<context>\n"
+    + "rome weather forecast rain sun temperature wind " * 150
+    + "\n</context>"
+)
+
+CONVERSATIONS = {
+    "single question": [
+        {"role": "user", "content": "What is the weather in Rome?"},
+    ],
+    "short chat": [
+        {"role": "user", "content": "Hi!"},
+        {"role": "assistant", "content": "Hello! How can I help you today?"},
+        {"role": "user", "content": "What time is it?"},
+    ],
+    "long answers": [
+        {"role": "user", "content": "Explain how a transformer works."},
+        {"role": "assistant", "content": "A transformer is a neural network architecture. " * 80},
+        {"role": "user", "content": "And what about attention?"},
+        {"role": "assistant", "content": "Attention weighs every token against the others. " * 80},
+        {"role": "user", "content": "Search the latest news about transformers"},
+    ],
+    "injected context": [
+        {"role": "system", "content": INJECTED_CONTEXT},
+        {"role": "user", "content": "What is the weather in Rome?"},
+        {"role": "assistant", "content": "It is sunny in Rome, 24 degrees. " * 10},
+        {"role": "user", "content": "And in Paris?"},
+    ],
+    "multimodal": [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What is in this picture, and what's the date today?"},
+                {"type": "image_url", "image_url": {"url": "data:image/png;base64," + "A" * 4000}},
+            ],
+        },
+    ],
+}
+
+
+async def run(args):
+    with FakeOllama(latency=args.latency, prefill_per_1k_chars=args.prefill_per_1k_chars) as ollama:
+        pipeline = Pipeline()
+        pipeline.valves.OLLAMA_API_BASE_URL = ollama.url
+        pipeline.valves.ROUTER_MODE = "off"
+        pipeline.valves.DECISION_CACHE_TTL = 0
+        # Keep only the report
+        pipeline.valves.LOG_LEVEL = "WARNING"
+        # Every run must reach the task model
+        pipeline.valves.RATE_LIMIT_USER_PER_MINUTE = 0
+        pipeline.valves.SHED_TASK_MODEL_LATENCY = 0
+        await pipeline.on_startup()
+
+        print(f"{'conversation':<18} {'mode':<8} {'prompt chars':>12} {'~tokens':>8} {'latency ms':>11}")
+        for name, messages in CONVERSATIONS.items():
+            for mode in ("full", "compact"):
+                pipeline.valves.PROMPT_MODE = mode
+                latencies = []
+                for _ in range(args.runs):
+                    ollama.prompt_chars.clear()
+                    body = {"messages": [dict(message) for message in messages]}
+                    start = time.perf_counter()
+                    await pipeline.inlet(body, {"id": "bench"})
+                    latencies.append(time.perf_counter() - start)
+                chars = ollama.prompt_chars[-1]
+                print(
+                    f"{name:<18} {mode:<8} {chars:>12} {chars // 4:>8} "
+                    f"{statistics.median(latencies) * 1000:>11.1f}"
+                )
+
+        await pipeline.on_shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--prefill-per-1k-chars", type=float, default=0.02)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Measures the cold start time of a pipeline: importing its module and creating
+the Pipeline, as the pipelines server does when a worker boots or reloads.
+
+Every sample runs in a fresh interpreter so nothing is shared between runs.
+
+Usage: python benchmarks/bench_startup.py [--module pipelines.function_calling_filters_pipeline_custom] [--runs 10]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SNIPPET = """
+import time
+start = time.perf_counter()
+import importlib
+module = importlib.import_module({module!r})
+module.Pipeline()
+print(time.perf_counter() - start)
+"""
+
+
+def sample(module: str) -> float:
+    output = subprocess.run(
+        [sys.executable, "-c", SNIPPET.format(module=module)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--module", default="pipelines.function_calling_filters_pipeline_custom"
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    samples = [sample(args.module) for _ in range(args.runs)]
+    print(
+        f"{args.module}: median {statistics.median(samples) * 1000:.1f} ms, "
+        f"min {min(samples) * 1000:.1f} ms, max {max(samples) * 1000:.1f} ms "
+        f"over {args.runs} runs"
+    )
+
+
+if __name__ == "__main__":
+    main()
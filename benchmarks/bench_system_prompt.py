@@ -0,0 +1,61 @@
+"""
+Checks that the system message stays the same size over a long conversation where
+a tool fires on every turn, against a local stand-in for Ollama.
+
+Each turn sends the messages returned by the previous inlet call plus an assistant
+answer and a new question, as Open WebUI does. The script prints the size of the
+system message and of the task model prompt every --every turns, and exits with
+status 1 if the system message grew after the first turn.
+
+Usage: python benchmarks/bench_system_prompt.py [--turns 50] [--every 10]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeOllama
+from pipelines.function_calling_filters_pipeline_custom import Pipeline
+
+
+async def run(args) -> bool:
+    with FakeOllama(latency=0) as ollama:
+        pipeline = Pipeline()
+        pipeline.valves.OLLAMA_API_BASE_URL = ollama.url
+        pipeline.valves.ROUTER_MODE = "off"
+        pipeline.valves.DECISION_CACHE_TTL = 0
+        pipeline.valves.LOG_LEVEL = "WARNING"
+        pipeline.valves.RATE_LIMIT_USER_PER_MINUTE = 0
+        await pipeline.on_startup()
+
+        messages = [{"role": "system", "content": "You are a helpful assistant."}]
+        sizes = []
+        print(f"{'turn':>5} {'system chars':>13} {'task prompt chars':>18}")
+        for turn in range(1, args.turns + 1):
+            messages = messages + [{"role": "user", "content": f"What is the date today? ({turn})"}]
+            body = await pipeline.inlet({"messages": messages}, {"id": "bench"})
+            messages = body["messages"] + [{"role": "assistant", "content": f"Today is the day {turn}."}]
+            sizes.append(len(messages[0]["content"]))
+            if turn == 1 or turn % args.every == 0:
+                print(f"{turn:>5} {sizes[-1]:>13} {ollama.prompt_chars[-1]:>18}")
+
+        await pipeline.on_shutdown()
+
+    flat = max(sizes) == sizes[0]
+    print("system message size is flat" if flat else f"system message grew from {sizes[0]} to {max(sizes)} chars")
+    return flat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--every", type=int, default=10)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Micro-benchmark of the web_scraper text normalization.
+
+Compares the original per-call implementation (stopword list rebuilt for every
+token, new lemmatizer for every page) with TextNormalizer, one page at a time
+and in batch mode, on a fixed synthetic corpus.
+
+Usage: python benchmarks/bench_text_normalizer.py [--pages 50] [--words 1500]
+Requires the punkt, stopwords and wordnet NLTK resources.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nltk.tokenize import word_tokenize, sent_tokenize
+from nltk.corpus import stopwords
+from nltk.stem import WordNetLemmatizer
+
+from blueprints.text_processing import TextNormalizer
+
+VOCABULARY = (
+    "the of and to in is was for that with on as by at from it be are this an "
+    "which or have has had not but were their its they been more one all would "
+    "there can new also other after first about these two some when into only "
+    "city cities weather forecast temperatures rising markets stocks prices "
+    "election elections voters candidates results running runners studies "
+    "researchers found analysis data models networks servers requests latency "
+    "companies announced products releases features users developers languages "
+    "children women men people years days months countries governments policies"
+).split()
+
+
+def build_corpus(pages: int, words: int, seed: int = 0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(pages):
+        sentences = []
+        remaining = words
+        while remaining > 0:
+            length = min(remaining, rng.randint(8, 25))
+            sentence = " ".join(rng.choice(VOCABULARY) for _ in range(length))
+            sentences.append(sentence.capitalize() + rng.choice([".", ".", "!", "?"]))
+            remaining -= length
+        corpus.append(" ".join(sentences))
+    return corpus
+
+
+def legacy_normalize(text):
+    tokens = word_tokenize(text)
+    tokens = [token for token in tokens if token.isalnum()]
+    tokens = [token for token in tokens if token not in stopwords.words("english")]
+    lemmatizer = WordNetLemmatizer()
+    tokens = [lemmatizer.lemmatize(token) for token in tokens]
+    formatted_text = " ".join(tokens)
+    return sent_tokenize(formatted_text)
+
+
+def run(name, fn, corpus, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(corpus)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<12} {len(corpus) / best:10.1f} pages/s  ({best * 1000:.1f} ms)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=50)
+    parser.add_argument("--words", type=int, default=1500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.pages, args.words)
+    normalizer = TextNormalizer()
+    # Warm up WordNet loading so it is not charged to the first implementation
+    normalizer.normalize(corpus[0])
+
+    before = run("legacy", lambda docs: [legacy_normalize(d) for d in docs], corpus, args.repeat)
+    after = run("normalizer", lambda docs: [normalizer.normalize(d) for d in docs], corpus, args.repeat)
+    batch = run("batch", normalizer.normalize_batch, corpus, args.repeat)
+
+    assert before == after == batch, "normalizer output differs from the legacy implementation"
+    print(normalizer.cache_info())
+
+
+if __name__ == "__main__":
+    main()
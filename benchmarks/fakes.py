@@ -0,0 +1,295 @@
+"""
+Local stand-ins for the HTTP services the pipelines call, for benchmarks.
+
+Every fake runs a ThreadingHTTPServer on a free local port in a daemon thread
+and has a configurable latency.
+"""
+
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+
+class BacklogHTTPServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 resets connections under a concurrent load test
+    request_queue_size = 256
+
+
+class FakeServer:
+    def __init__(self):
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = BacklogHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def query(self) -> dict:
+                return {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+
+            def read_json(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def send_json(self, data, status=200):
+                self.send_text(json.dumps(data), status, "application/json")
+
+            def send_text(self, text, status=200, content_type="text/plain; charset=utf-8"):
+                payload = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def send_chunks(self, chunks, content_type="application/json"):
+                """
+                Sends an iterable of strings with chunked transfer encoding, flushing each one.
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for chunk in chunks:
+                    data = chunk.encode()
+                    self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+            def do_GET(self):
+                fake.count()
+                fake.handle_get(self)
+
+            def do_POST(self):
+                fake.count()
+                fake.handle_post(self)
+
+        return Handler
+
+    def handle_get(self, request):
+        request.send_json({"error": "not found"}, 404)
+
+    def handle_post(self, request):
+        request.send_json({"error": "not found"}, 404)
+
+
+class FakeOllama(FakeServer):
+    """
+    Answers /api/chat with a fixed function call, or with the answer of responder
+    if given, called with the request body. The latency models prefill and
+    decoding: latency + prompt characters / 1000 * prefill_per_1k_chars.
+    """
+
+    def __init__(
+        self,
+        content: str = '{"name": "get_current_date", "parameters": {}}',
+        latency: float = 0.2,
+        prefill_per_1k_chars: float = 0.02,
+        responder: Optional[Callable[[dict], str]] = None,
+    ):
+        self.content = content
+        self.responder = responder
+        self.latency = latency
+        self.prefill_per_1k_chars = prefill_per_1k_chars
+        self.prompt_chars = []
+        super().__init__()
+
+    def handle_post(self, request):
+        body = request.read_json()
+        chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+        self.prompt_chars.append(chars)
+        content = self.responder(body) if self.responder else self.content
+        time.sleep(self.latency + chars / 1000 * self.prefill_per_1k_chars)
+        request.send_json(
+            {
+                "model": body.get("model"),
+                "message": {"role": "assistant", "content": content},
+                "done": True,
+                "prompt_eval_count": chars // 4,
+                "eval_count": len(content) // 4,
+                "eval_duration": int(self.latency * 1e9),
+            }
+        )
+
+
+WORDS = (
+    "the of and to in is was for that with on as by at from city weather forecast "
+    "temperatures markets prices election voters results researchers found analysis "
+    "data models servers requests latency companies announced products releases "
+    "features users developers people years countries governments policies"
+).split()
+
+
+def synthetic_text(seed: str, words: int, sentence_words: int = 18) -> str:
+    """
+    Builds a deterministic text of about the given number of words, one sentence per line.
+    """
+    rng = random.Random(zlib.crc32(seed.encode()))
+    lines = []
+    for start in range(0, words, sentence_words):
+        sentence = rng.choices(WORDS, k=min(sentence_words, words - start))
+        lines.append(" ".join(sentence).capitalize() + ".")
+    return "\n".join(lines)
+
+
+class FakeBrave(FakeServer):
+    """
+    Answers the Brave web search with `results` fresh results. Their urls can be
+    read through a FakeJina by setting the reader url of the pipeline to the FakeJina url + "/".
+    """
+
+    def __init__(self, latency: float = 0.1, results: int = 5):
+        self.latency = latency
+        self.results = results
+        super().__init__()
+
+    def handle_get(self, request):
+        query = request.query().get("q", "")
+        time.sleep(self.latency)
+        page_age = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        request.send_json(
+            {
+                "web": {
+                    "results": [
+                        {
+                            "title": f"{query} {i}",
+                            "url": f"https://example.com/{zlib.crc32(query.encode())}/{i}",
+                            "page_age": page_age,
+                        }
+                        for i in range(self.results)
+                    ]
+                }
+            }
+        )
+
+
+class FakeJina(FakeServer):
+    """
+    Answers any GET with a deterministic synthetic page of page_words words.
+    """
+
+    def __init__(self, latency: float = 0.2, page_words: int = 1500):
+        self.latency = latency
+        self.page_words = page_words
+        super().__init__()
+
+    def handle_get(self, request):
+        time.sleep(self.latency)
+        request.send_text(synthetic_text(request.path, self.page_words))
+
+
+class FakeOpenWeatherMap(FakeServer):
+    """
+    Answers the OpenWeatherMap current weather endpoints for any city: /weather?q=... and,
+    for the ids it already handed out, /group?id=.... The calls of each endpoint are counted
+    in `endpoints`.
+    """
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.cities = {}
+        self.endpoints = {"weather": 0, "group": 0}
+        super().__init__()
+
+    def observation(self, city: str, units: str) -> dict:
+        temperature = 10 + zlib.crc32(city.encode()) % 200 / 10
+        if units == "imperial":
+            temperature = temperature * 9 / 5 + 32
+        city_id = zlib.crc32(city.encode()) % 10_000_000
+        self.cities[city_id] = city
+        return {
+            "id": city_id,
+            "name": city,
+            "weather": [{"description": "scattered clouds"}],
+            "main": {"temp": round(temperature, 2)},
+        }
+
+    def handle_get(self, request):
+        endpoint = urlsplit(request.path).path.rsplit("/", 1)[-1]
+        if endpoint not in self.endpoints:
+            return super().handle_get(request)
+        query = request.query()
+        with self.lock:
+            self.endpoints[endpoint] += 1
+        time.sleep(self.latency)
+        if endpoint == "weather":
+            request.send_json(self.observation(query.get("q", "Nowhere"), query.get("units")))
+            return
+        ids = [int(city_id) for city_id in query.get("id", "").split(",") if city_id]
+        observations = [
+            self.observation(self.cities[city_id], query.get("units"))
+            for city_id in ids
+            if city_id in self.cities
+        ]
+        request.send_json({"cnt": len(observations), "list": observations})
+
+
+class FakeN8n(FakeServer):
+    """
+    Stands in for an n8n webhook answering in `chunks` pieces of `words` words, `delay`
+    seconds apart. POST /stream streams them as n8n JSON lines, any other path sends
+    {"output": ...} once the last piece is ready.
+    """
+
+    def __init__(self, chunks: int = 20, delay: float = 0.05, words: int = 1):
+        self.chunks = chunks
+        self.delay = delay
+        self.words = words
+        super().__init__()
+
+    def handle_post(self, request):
+        request.read_json()
+        pieces = [
+            " ".join(f"word{i}" for i in range(chunk * self.words, (chunk + 1) * self.words)) + " "
+            for chunk in range(self.chunks)
+        ]
+
+        if urlsplit(request.path).path == "/stream":
+            def lines():
+                yield json.dumps({"type": "begin"}) + "\n"
+                for i, piece in enumerate(pieces):
+                    if i:
+                        time.sleep(self.delay)
+                    yield json.dumps({"type": "item", "content": piece}) + "\n"
+                yield json.dumps({"type": "end"}) + "\n"
+
+            request.send_chunks(lines())
+        else:
+            time.sleep(self.delay * (self.chunks - 1))
+            request.send_json({"output": "".join(pieces)})
@@ -0,0 +1,343 @@
+"""
+Load test of the function calling filter and the n8n Pipe, plus CPU micro-benchmarks,
+against local stand-ins for Ollama, Brave, jina, OpenWeatherMap and n8n.
+
+--conversations conversations run concurrently through Pipeline.inlet, each sending
+--turns queries that cycle through the date, weather and search tools, then the same
+number of requests go through Pipe.pipe. Latency percentiles, throughput and the
+per-stage timings of the pipeline are printed and saved as JSON; with --baseline,
+the results are compared with a previous run.
+
+Usage: python benchmarks/load_test.py [--conversations 20] [--turns 3] [--output results.json] [--baseline old.json]
+The web_scraper micro-benchmark requires the punkt, stopwords and wordnet NLTK resources.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeBrave, FakeJina, FakeN8n, FakeOllama, FakeOpenWeatherMap
+from blueprints.function_blueprint import doc_to_dict, get_tools_specs
+from blueprints.metrics import metrics
+from pipelines.function_calling_filters_pipeline_custom import Pipeline, web_scraper
+from pipelines.n8n import Pipe
+
+QUERIES = (
+    ("date", "What is the date today? ({id})"),
+    ("weather", "What's the weather like in City{id}?"),
+    ("search", "Search the web for the latest news about topic {id}"),
+)
+
+
+def respond(body: dict) -> str:
+    """
+    Picks the function call the task model would answer for the query of a request.
+    """
+    content = body["messages"][-1]["content"]
+    query = content.rsplit("Query:", 1)[-1].strip()
+    if "weather" in query:
+        city = query.rsplit(" in ", 1)[-1].rstrip("?")
+        call = {"name": "get_current_weather", "parameters": {"location": city, "unit": "metric"}}
+    elif "Search" in query:
+        call = {"name": "bravesearch", "parameters": {"query": query}}
+    else:
+        call = {"name": "get_current_date", "parameters": {}}
+    return json.dumps({"calls": [call]})
+
+
+def summarize(samples) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": percentile(0.50) * 1000,
+        "p95_ms": percentile(0.95) * 1000,
+        "p99_ms": percentile(0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+async def conversation(pipeline: Pipeline, index: int, turns: int, repeat: bool, samples: dict):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(turns):
+        kind, template = QUERIES[(index + turn) % len(QUERIES)]
+        query = template.format(id=index % 3 if repeat else f"{index}-{turn}")
+        messages.append({"role": "user", "content": query})
+        start = time.perf_counter()
+        body = await pipeline.inlet({"messages": [dict(message) for message in messages]}, {"id": f"user{index}"})
+        samples.setdefault(kind, []).append(time.perf_counter() - start)
+        # Keep the system prompt the filter injected, as Open WebUI would
+        messages = body["messages"] + [{"role": "assistant", "content": f"Answer {turn}."}]
+
+
+async def run_filter(args, fakes) -> dict:
+    ollama, brave, jina, weather = fakes
+    pipeline = Pipeline()
+    valves = pipeline.valves
+    valves.OLLAMA_API_BASE_URL = ollama.url
+    valves.OPENWEATHERMAP_API_URL = weather.url
+    valves.OPENWEATHERMAP_API_KEY = "bench"
+    valves.BRAVE_API_URL = brave.url
+    valves.BRAVE_API_KEY = "bench"
+    valves.JINA_READER_URL = jina.url + "/"
+    valves.ROUTER_MODE = args.router
+    valves.SPECULATIVE_MODE = args.speculative
+    valves.LOG_LEVEL = "ERROR"
+    if not args.rate_limits:
+        valves.RATE_LIMIT_USER_PER_MINUTE = 0
+        valves.RATE_LIMIT_GLOBAL_PER_MINUTE = 0
+        valves.SHED_TASK_MODEL_LATENCY = 0
+    if not args.repeat_queries:
+        valves.PAGE_CACHE_PATH = ""
+    await pipeline.on_startup()
+
+    metrics.clear()
+    samples = {}
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            conversation(pipeline, index, args.turns, args.repeat_queries, samples)
+            for index in range(args.conversations)
+        ]
+    )
+    elapsed = time.perf_counter() - start
+    speculation = pipeline.speculation_rates()
+    shedding = pipeline.shedding_stats()
+    await pipeline.on_shutdown()
+
+    requests = sum(len(values) for values in samples.values())
+    stages = {
+        entry["labels"]["stage"] + (f":{entry['labels']['tool']}" if "tool" in entry["labels"] else ""): {
+            "count": entry["count"],
+            "mean_ms": entry["mean"] * 1000,
+        }
+        for entry in metrics.snapshot().get("pipeline_stage_duration_seconds", [])
+    }
+    outcomes = {
+        entry["labels"]["outcome"]: entry["value"]
+        for entry in metrics.snapshot().get("function_calling_requests_total", [])
+    }
+    return {
+        "requests": requests,
+        "seconds": elapsed,
+        "throughput_rps": requests / elapsed,
+        "latency": summarize([value for values in samples.values() for value in values]),
+        "latency_by_tool": {kind: summarize(values) for kind, values in samples.items()},
+        "outcomes": outcomes,
+        "speculation": speculation,
+        "shedding": shedding,
+        "stages": stages,
+    }
+
+
+async def run_n8n(args, n8n: FakeN8n) -> dict:
+    results = {}
+    pipe = Pipe()
+    pipe.valves.max_in_flight = args.conversations
+    for name, path, streaming in (("single_shot", "/single", False), ("streaming", "/stream", True)):
+        pipe.valves.n8n_url = n8n.url + path
+        pipe.valves.enable_streaming = streaming
+        latencies, first_tokens, failed = [], [], []
+        admission = pipe.metrics()
+
+        async def call(index: int):
+            body = {"messages": [{"role": "user", "content": f"hello {index}"}], "stream": True}
+            start = time.perf_counter()
+            result = await pipe.pipe(body, __user__={"id": f"user{index}"})
+            if isinstance(result, dict):
+                # Turned away by the in-flight limit of the Pipe, or failed
+                failed.append(result.get("error"))
+                return
+            if isinstance(result, str):
+                first = time.perf_counter() - start
+            else:
+                first = error = None
+                async for chunk in result:
+                    content = chunk["choices"][0]["delta"].get("content")
+                    # Errors of a stream, admission included, come as a last "Error: ..." chunk
+                    if content and content.startswith("Error: ") and chunk["choices"][0].get("finish_reason"):
+                        error = content
+                    elif first is None and content:
+                        first = time.perf_counter() - start
+                if error is not None:
+                    failed.append(error)
+                    return
+            first_tokens.append(first or time.perf_counter() - start)
+            latencies.append(time.perf_counter() - start)
+
+        count = args.conversations * args.turns
+        start = time.perf_counter()
+        await asyncio.gather(*[call(index) for index in range(count)])
+        elapsed = time.perf_counter() - start
+        after = pipe.metrics()
+        results[name] = {
+            "requests": count,
+            "completed": len(latencies),
+            "failed": len(failed),
+            "rejected": after["rejected"] + after["timed_out"] - admission["rejected"] - admission["timed_out"],
+            "seconds": elapsed,
+            "throughput_rps": len(latencies) / elapsed,
+            "latency": summarize(latencies),
+            "time_to_first_token": summarize(first_tokens),
+        }
+    await pipe.on_shutdown()
+    return results
+
+
+def best_time(function, number: int, repeat: int = 5) -> float:
+    """
+    Returns the best time of one call in microseconds, out of repeat runs of number calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best * 1e6
+
+
+def run_micro(args, jina_url: str) -> dict:
+    tools = Pipeline().tools
+    docstring = tools.get_current_weather.__doc__
+    results = {
+        "get_tools_specs_us": best_time(lambda: get_tools_specs(tools), 200),
+        "doc_to_dict_us": best_time(lambda: doc_to_dict(docstring), 5000),
+    }
+    try:
+        results["web_scraper_us"] = best_time(
+            lambda: web_scraper("https://example.com/page", reader_url=jina_url + "/"), 20
+        )
+    except LookupError as e:
+        results["web_scraper_us"] = None
+        results["web_scraper_skipped"] = str(e)
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Prints the relative change of the throughputs, the p95 latencies and the micro-benchmarks.
+    """
+
+    def rows(current, previous, path=""):
+        for key, value in current.items():
+            old = previous.get(key) if isinstance(previous, dict) else None
+            name = f"{path}.{key}" if path else key
+            if isinstance(value, dict):
+                yield from rows(value, old or {}, name)
+            elif (
+                isinstance(value, (int, float))
+                and isinstance(old, (int, float))
+                and old
+                and (key in ("throughput_rps", "p95_ms") or key.endswith("_us"))
+            ):
+                yield name, old, value
+
+    print("\ncompared with the baseline:")
+    for name, old, new in rows(results, baseline):
+        print(f"{name:<60} {old:>12.2f} -> {new:>12.2f} ({(new - old) / old * 100:+6.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--router", choices=("off", "shadow", "on"), default="shadow")
+    parser.add_argument("--speculative", action="store_true", help="start the slow tools while the task model decides")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the default rate limits and load shedding")
+    parser.add_argument("--repeat-queries", action="store_true", help="reuse the same few queries, to exercise the caches")
+    parser.add_argument("--ollama-latency", type=float, default=0.2)
+    parser.add_argument("--brave-latency", type=float, default=0.1)
+    parser.add_argument("--brave-results", type=int, default=5)
+    parser.add_argument("--jina-latency", type=float, default=0.2)
+    parser.add_argument("--page-words", type=int, default=1500)
+    parser.add_argument("--weather-latency", type=float, default=0.05)
+    parser.add_argument("--n8n-chunks", type=int, default=20)
+    parser.add_argument("--n8n-delay", type=float, default=0.02)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument(
+        "--output",
+        default=os.path.join(tempfile.gettempdir(), "load_test_results.json"),
+        help="where the results are saved, in the temporary directory by default",
+    )
+    parser.add_argument("--baseline", help="a previous result file to compare with")
+    args = parser.parse_args()
+
+    fakes = (
+        FakeOllama(latency=args.ollama_latency, responder=respond),
+        FakeBrave(latency=args.brave_latency, results=args.brave_results),
+        FakeJina(latency=args.jina_latency, page_words=args.page_words),
+        FakeOpenWeatherMap(latency=args.weather_latency),
+    )
+    n8n = FakeN8n(chunks=args.n8n_chunks, delay=args.n8n_delay)
+    micro_jina = FakeJina(latency=0, page_words=args.page_words)
+    for fake in (*fakes, n8n, micro_jina):
+        fake.start()
+
+    try:
+        results = {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "args": vars(args),
+            },
+            "filter": asyncio.run(run_filter(args, fakes)),
+            "n8n": asyncio.run(run_n8n(args, n8n)),
+        }
+        if not args.skip_micro:
+            results["micro"] = run_micro(args, micro_jina.url)
+    finally:
+        for fake in (*fakes, n8n, micro_jina):
+            fake.stop()
+
+    filter_results = results["filter"]
+    print(f"filter  {filter_results['requests']} requests, {filter_results['throughput_rps']:.1f} req/s")
+    for kind, latency in filter_results["latency_by_tool"].items():
+        print(
+            f"  {kind:<10} p50 {latency['p50_ms']:8.1f} ms  p95 {latency['p95_ms']:8.1f} ms  p99 {latency['p99_ms']:8.1f} ms"
+        )
+    print(f"  outcomes {filter_results['outcomes']}")
+    if args.speculative:
+        print(f"  speculation {filter_results['speculation']}")
+    if args.rate_limits:
+        print(f"  shedding {filter_results['shedding']}")
+    for name, n8n_results in results["n8n"].items():
+        latency, first = n8n_results["latency"], n8n_results["time_to_first_token"]
+        print(
+            f"n8n {name:<12} {n8n_results['throughput_rps']:.1f} req/s  p50 {latency['p50_ms']:8.1f} ms  "
+            f"p95 {latency['p95_ms']:8.1f} ms  p99 {latency['p99_ms']:8.1f} ms  first token p50 {first['p50_ms']:8.1f} ms  "
+            f"rejected {n8n_results['rejected']}  failed {n8n_results['failed']}"
+        )
+    for name, value in results.get("micro", {}).items():
+        if isinstance(value, float):
+            print(f"{name:<20} {value:10.1f}")
+        elif isinstance(value, str):
+            print(f"{name:<20} {value}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,435 @@
+from typing import Any, Callable, Dict, Hashable, Optional, Sequence
+from collections import OrderedDict
+from concurrent.futures import Future
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from blueprints.text_processing import normalize_query
+from blueprints.tool_execution import current_cancel_event
+
+# Returned by TTLCache.get for missing keys when None is a legitimate cached value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread safe in-memory LRU cache whose entries expire after a TTL.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        """
+        :param maxsize: Maximum number of entries, the least recently used are evicted first.
+        :param ttl: Default lifetime of an entry in seconds.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value cached for a key.
+        :param key: The cache key.
+        :param default: Returned when the key is missing or expired.
+        :return: The cached value or the default.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value cached for a key without counting a hit or a miss.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return default
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """
+        Caches a value.
+        :param key: The cache key.
+        :param value: The value to cache.
+        :param ttl: The lifetime of this entry in seconds, the cache TTL by default.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+            "entries": len(self._data),
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls: while a call for a key is running, other callers
+    with the same key wait for it and share its result instead of repeating it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Calls fn unless a call with the same key is already in flight.
+        :param key: The key identifying identical calls.
+        :param fn: The function to call.
+        :return: The result of fn, or the exception it raised.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+                self.calls += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced}
+
+
+def cached_tool(ttl: float, key: Optional[Sequence[str]] = None, maxsize: int = 256):
+    """
+    Declares the result cache policy of a tool method. Tools without it are never cached.
+
+    Example:
+        @cached_tool(ttl=600, key=("location", "unit"))
+        def get_current_weather(self, location: str, unit: str = "metric") -> str:
+
+    :param ttl: Lifetime of a cached result in seconds.
+    :param key: The parameters the cache key is built from, all of them by default.
+    :param maxsize: Maximum number of results cached for the tool.
+    """
+
+    def decorator(function):
+        function.__tool_cache_policy__ = {"ttl": ttl, "key": key, "maxsize": maxsize}
+        return function
+
+    return decorator
+
+
+class ToolResultCache:
+    """
+    Memoizes tool results according to the policy declared with cached_tool, one TTLCache per tool.
+    """
+
+    def __init__(self):
+        self._caches: Dict[str, TTLCache] = {}
+        self._signatures: Dict[str, inspect.Signature] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name: str, function: Callable, parameters: dict, fields) -> str:
+        signature = self._signatures.get(name)
+        if signature is None:
+            signature = self._signatures[name] = inspect.signature(function)
+        bound = signature.bind(**parameters)
+        bound.apply_defaults()
+        arguments = {
+            field: value
+            for field, value in bound.arguments.items()
+            if fields is None or field in fields
+        }
+        # Case, spacing and trailing punctuation of string arguments do not change the result of a lookup
+        arguments = {
+            field: normalize_query(value) if isinstance(value, str) else value
+            for field, value in arguments.items()
+        }
+        return json.dumps(arguments, sort_keys=True, default=str)
+
+    def call(self, name: str, function: Callable, parameters: dict) -> Any:
+        """
+        Calls a tool, returning the cached result when its policy allows it.
+        :param name: The name of the tool.
+        :param function: The tool method.
+        :param parameters: The parameters to call the tool with.
+        :return: The tool result.
+        """
+        cache, key = self._lookup(name, function, parameters)
+        if cache is None:
+            return function(**parameters)
+
+        result = cache.get(key, MISSING)
+        if result is MISSING:
+            result = function(**parameters)
+            # Empty results usually mean a failed lookup, let the next call try again.
+            # A cancelled call may have returned what it had so far, never memoize it.
+            if result and not current_cancel_event().is_set():
+                cache.set(key, result)
+        return result
+
+    async def acall(self, name: str, function: Callable, parameters: dict) -> Any:
+        """
+        Same as call, for tools that are coroutine functions.
+        """
+        cache, key = self._lookup(name, function, parameters)
+        if cache is None:
+            return await function(**parameters)
+
+        result = cache.get(key, MISSING)
+        if result is MISSING:
+            result = await function(**parameters)
+            if result and not current_cancel_event().is_set():
+                cache.set(key, result)
+        return result
+
+    def _lookup(self, name: str, function: Callable, parameters: dict):
+        policy = getattr(function, "__tool_cache_policy__", None)
+        if policy is None:
+            return None, None
+
+        cache = self._caches.get(name)
+        if cache is None:
+            with self._lock:
+                cache = self._caches.setdefault(
+                    name, TTLCache(maxsize=policy["maxsize"], ttl=policy["ttl"])
+                )
+        return cache, self._key(name, function, parameters, policy["key"])
+
+    def clear(self):
+        with self._lock:
+            self._caches.clear()
+            self._signatures.clear()
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the cache statistics of each tool that has a cache policy.
+        """
+        return {name: cache.stats() for name, cache in self._caches.items()}
+
+
+class PersistentCache:
+    """
+    JSON value cache stored in a SQLite file, with TTL expiry and LRU eviction.
+
+    The file can be shared by several worker processes: every thread opens its own
+    connection, the database runs in WAL mode and the hit/miss/eviction counters are
+    kept in the database, so they add up across processes.
+    """
+
+    STATS = ("hits", "misses", "expirations", "evictions", "writes")
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 3600,
+        max_entries: int = 1000,
+        max_bytes: int = 0,
+    ):
+        """
+        :param path: The SQLite file, created if it does not exist.
+        :param ttl: Seconds after which an entry expires, 0 keeps entries until they are evicted.
+        :param max_entries: Maximum number of entries, 0 for no limit.
+        :param max_bytes: Maximum total size of the stored values in bytes, 0 for no limit.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        connection = self._connection()
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _count(self, connection: sqlite3.Connection, name: str, value: int = 1):
+        if value:
+            connection.execute(
+                "INSERT INTO stats (name, value) VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                (name, value),
+            )
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the value stored for a key, or None if it is missing or expired.
+        :param key: The cache key.
+        :return: The cached value.
+        """
+        connection = self._connection()
+        now = time.time()
+        row = connection.execute(
+            "SELECT value, created FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            self._count(connection, "misses")
+            return None
+
+        value, created = row
+        if self.ttl and now - created > self.ttl:
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._count(connection, "expirations")
+                self._count(connection, "misses")
+            return None
+
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "UPDATE entries SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._count(connection, "hits")
+        return json.loads(value)
+
+    def set(self, key: str, value: Any):
+        """
+        Stores a JSON serializable value, evicting the least recently used entries if the cache is full.
+        :param key: The cache key.
+        :param value: The value to store.
+        """
+        serialized = json.dumps(value)
+        size = len(serialized.encode("utf-8"))
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        connection = self._connection()
+        now = time.time()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, serialized, size, now, now),
+            )
+            self._count(connection, "writes")
+            self._count(connection, "evictions", self._evict(connection))
+
+    def _evict(self, connection: sqlite3.Connection) -> int:
+        evicted = 0
+
+        if self.max_entries:
+            (count,) = connection.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if count > self.max_entries:
+                evicted += connection.execute(
+                    "DELETE FROM entries WHERE key IN "
+                    "(SELECT key FROM entries ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+
+        if self.max_bytes:
+            (total,) = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                victims = []
+                for key, size in connection.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed"
+                ):
+                    victims.append((key,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                connection.executemany("DELETE FROM entries WHERE key = ?", victims)
+                evicted += len(victims)
+
+        return evicted
+
+    def delete(self, key: str):
+        self._connection().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM stats")
+
+    def stats(self) -> dict:
+        """
+        Returns the counters shared by every process using the cache file.
+        :return: The hits, misses, expirations, evictions and writes, and the current entries and bytes.
+        """
+        connection = self._connection()
+        stats = {name: 0 for name in self.STATS}
+        stats.update(connection.execute("SELECT name, value FROM stats").fetchall())
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        stats["entries"] = entries
+        stats["bytes"] = size
+        return stats
@@ -1,11 +1,31 @@
-from typing import List, Optional, get_type_hints, Literal
+from typing import Callable, Dict, List, Optional, get_type_hints, Literal
 from pydantic import BaseModel
 import os
-import requests
+import httpx
 import json
 import inspect
 import uuid
 import time
+import hashlib
+import asyncio
+import re
+import logging
+
+from blueprints.caching import MISSING, TTLCache, ToolResultCache
+from blueprints.metrics import LazyJson, configure_logging, metrics
+from blueprints.resilience import LatencyWindow, RateLimiter, ResilientHTTP
+from blueprints.routing import RouteDecision, ToolRouter
+from blueprints.text_processing import normalize_query
+from blueprints.tool_execution import (
+    Speculation,
+    ToolCallResult,
+    ToolExecutor,
+    format_tool_results,
+    merge_batched_calls,
+    parse_function_calls,
+)
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -49,23 +69,61 @@ def get_last_assistant_message(messages: List[dict]) -> str:
             return message["content"]
     return None
 
-def add_or_update_system_message(content: str, messages: List[dict]):
+def get_message_text(message: dict) -> str:
+    """
+    Returns the text of a message, flattening multimodal content parts.
+    """
+    content = message.get("content")
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if item.get("type") == "text":
+                parts.append(item.get("text", ""))
+            else:
+                parts.append(f"[{item.get('type', 'attachment')}]")
+        return " ".join(parts)
+    return content or ""
+
+def truncate_text(text: str, max_chars: int) -> str:
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text
+    if max_chars <= 3:
+        # No room for the ellipsis
+        return text[:max_chars]
+    return text[: max_chars - 3].rstrip() + "..."
+
+# Delimit the tool context injected in the system message, so that the next turn replaces it
+TOOL_CONTEXT_START = "<!-- tool-context:start -->"
+TOOL_CONTEXT_END = "<!-- tool-context:end -->"
+TOOL_CONTEXT_PATTERN = re.compile(
+    re.escape(TOOL_CONTEXT_START) + r".*?" + re.escape(TOOL_CONTEXT_END) + r"\n?", re.DOTALL
+)
+
+def strip_tool_context(text: str) -> str:
+    """
+    Removes the tool context blocks injected by add_or_update_system_message from a text.
+    """
+    return TOOL_CONTEXT_PATTERN.sub("", text)
+
+def add_or_update_system_message(content: str, messages: List[dict], max_chars: int = 0):
     """
-    Adds a new system message at the beginning of the messages list
-    or updates the existing system message at the beginning.
+    Adds the tool context at the beginning of the system message, replacing the context
+    injected on a previous turn, or adds a system message if there is none.
 
-    :param msg: The message to be added or appended.
+    :param content: The tool context to inject.
     :param messages: The list of message dictionaries.
-    :return: The updated list of message dictionaries.
+    :param max_chars: The maximum size of the injected context, 0 for no limit.
+    :return: The updated list of message dictionaries, the input messages are not modified.
     """
+    block = f"{TOOL_CONTEXT_START}\n{truncate_text(content, max_chars)}\n{TOOL_CONTEXT_END}"
 
     if messages and messages[0].get("role") == "system":
-        messages[0]["content"] += f"{content}\n{messages[0]['content']}"
-    else:
-        # Insert at the beginning
-        messages.insert(0, {"role": "system", "content": content})
+        original = strip_tool_context(get_message_text(messages[0]))
+        system = {**messages[0], "content": f"{block}\n{original}" if original else block}
+        return [system, *messages[1:]]
 
-    return messages
+    # Insert at the beginning
+    return [{"role": "system", "content": block}, *messages]
 
 def doc_to_dict(docstring):
     lines = docstring.split("\n")
@@ -137,6 +195,223 @@ def get_tools_specs(tools) -> List[dict]:
 
     return specs
 
+FUNCTION_CALLING_PROMPT = """
+If a function tool doesn't match the query, return an empty string. Else, pick a function tool, fill in the parameters from the function tool's schema, and return it in the format { "name": \"functionName\", "parameters": { "key": "value" } }. If the query needs several function calls, return a JSON list of such objects. Only pick a function if the user asks.  Only return the object or the list. Do not return any other text."
+"""
+
+def compact_tool_specs(specs: List[dict]) -> str:
+    """
+    Encodes the tool specs as one signature per line, e.g.
+    get_current_weather(location*: str "The location.", unit: metric|fahrenheit "The unit.") - Get the current weather.
+    Required parameters are marked with *.
+    """
+    lines = []
+    for spec in specs:
+        parameters = spec["parameters"]
+        arguments = []
+        for name, prop in parameters["properties"].items():
+            kind = "|".join(str(value) for value in prop["enum"]) if prop.get("enum") else prop["type"]
+            required = "*" if name in parameters["required"] else ""
+            description = prop.get("description", "")
+            note = f' "{description}"' if description and description != name else ""
+            arguments.append(f"{name}{required}: {kind}{note}")
+        lines.append(f"{spec['name']}({', '.join(arguments)}) - {spec['description']}")
+    return "\n".join(lines)
+
+COMPACT_FUNCTION_CALLING_PROMPT = """
+Answer with the function call as {"name":"functionName","parameters":{"key":"value"}}, filling the parameters from the user query; parameters marked * are required. If the query needs several calls, answer with a JSON list of them. If no function matches the query, or the user does not ask for it, return an empty string. Return only the object or the list, no other text."""
+
+# Used instead of the prompts above when the answer is constrained to the tool_calls_schema
+STRUCTURED_OUTPUT_PROMPT = """
+Pick the function tools the query needs and fill in their parameters from the function tool's schema. Answer with {"calls": [{"name": "functionName", "parameters": {"key": "value"}}]}, one object per call. If no function matches the query, or the user does not ask for it, answer with {"calls": []}. Only return the JSON object."""
+
+COMPACT_STRUCTURED_OUTPUT_PROMPT = """
+Answer with {"calls": [{"name":"functionName","parameters":{"key":"value"}}]}, one object per call, filling the parameters from the user query; parameters marked * are required. If no function matches the query, or the user does not ask for it, answer with {"calls": []}. Return only the JSON object."""
+
+def keep_alive_value(value: str):
+    """
+    Converts the keep_alive valve for Ollama, which takes a number of seconds or a duration string.
+    :param value: The valve, e.g. "30m", "24h" or "-1".
+    :return: The number for a numeric value, e.g. -1 to keep the model loaded for ever, otherwise the string.
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+# JSON schema types of the parameter types reported by get_tools_specs
+SCHEMA_TYPES = {
+    "str": "string",
+    "int": "integer",
+    "float": "number",
+    "bool": "boolean",
+    "list": "array",
+    "dict": "object",
+}
+
+def tool_calls_schema(specs: List[dict]) -> dict:
+    """
+    Builds the JSON schema of the task model answer: {"calls": [...]} where every call
+    names one of the tools and fills its parameters, an empty list meaning no function.
+    :param specs: The tool specs, as returned by get_tools_specs.
+    :return: The JSON schema.
+    """
+    variants = []
+    for spec in specs:
+        properties = {}
+        for name, prop in spec["parameters"]["properties"].items():
+            if prop.get("enum"):
+                properties[name] = {"enum": list(prop["enum"])}
+            elif prop["type"] in SCHEMA_TYPES:
+                properties[name] = {"type": SCHEMA_TYPES[prop["type"]]}
+            else:
+                properties[name] = {}
+        variants.append(
+            {
+                "type": "object",
+                "properties": {
+                    "name": {"enum": [spec["name"]]},
+                    "parameters": {
+                        "type": "object",
+                        "properties": properties,
+                        "required": list(spec["parameters"]["required"]),
+                    },
+                },
+                "required": ["name", "parameters"],
+            }
+        )
+    return {
+        "type": "object",
+        "properties": {
+            "calls": {"type": "array", "items": {"anyOf": variants}},
+        },
+        "required": ["calls"],
+    }
+
+class ToolRegistry:
+    """
+    Caches the tool specs of a Tools instance and the function calling system prompt built from them.
+
+    The cache is rebuilt only when the Tools class or the valves object changes, so
+    the specs are not extracted again on every inlet call.
+    """
+
+    def __init__(self):
+        self._tools_class = None
+        self._valves = None
+        self.specs: List[dict] = []
+        self.system_prompt: str = ""
+        self.hash: str = ""
+        self.router: Optional[ToolRouter] = None
+        self._prompts: Dict[tuple, str] = {}
+        self._schemas: Dict[Optional[tuple], dict] = {}
+        # Tools that can be started before the task model answers, with the builder of their provisional parameters
+        self.speculative: Dict[str, Callable[[str], Optional[dict]]] = {}
+
+    def get(self, tools, valves) -> "ToolRegistry":
+        """
+        Returns the registry for the given tools and valves, rebuilding it if they changed.
+        :param tools: The Tools instance of the pipeline.
+        :param valves: The valves of the pipeline.
+        :return: The up to date registry.
+        """
+        if type(tools) is not self._tools_class or valves is not self._valves:
+            self.build(tools, valves)
+        return self
+
+    def build(self, tools, valves):
+        with metrics.span("spec_build"):
+            self._build(tools, valves)
+        logger.info("Tool specs built for %d tools", len(self.specs))
+        logger.debug("Tool specs: %s", LazyJson(self.specs))
+
+    def _build(self, tools, valves):
+        specs = get_tools_specs(tools)
+        serialized = json.dumps(specs, sort_keys=True)
+
+        self.specs = specs
+        self.system_prompt = self.build_system_prompt(specs)
+        self.hash = hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+        self.router = ToolRouter(
+            specs,
+            {
+                spec["name"]: getattr(tools, spec["name"]).__raw_query_parameter__
+                for spec in specs
+                if hasattr(getattr(tools, spec["name"]), "__raw_query_parameter__")
+            },
+        )
+        self.speculative = {}
+        for spec in specs:
+            function = getattr(tools, spec["name"])
+            if not hasattr(function, "__speculative_arguments__"):
+                continue
+            arguments = function.__speculative_arguments__
+            parameter = self.router.raw_query_parameters.get(spec["name"])
+            if arguments is None and parameter:
+                arguments = lambda query, parameter=parameter: {parameter: query}
+            if arguments is not None:
+                self.speculative[spec["name"]] = arguments
+        self._prompts = {}
+        self._schemas = {}
+        self._tools_class = type(tools)
+        self._valves = valves
+
+    def build_system_prompt(
+        self, specs: List[dict], mode: str = "full", structured: bool = False
+    ) -> str:
+        if mode == "compact":
+            instructions = COMPACT_STRUCTURED_OUTPUT_PROMPT if structured else COMPACT_FUNCTION_CALLING_PROMPT
+            return f"Tools:\n{compact_tool_specs(specs)}" + instructions
+        instructions = STRUCTURED_OUTPUT_PROMPT if structured else FUNCTION_CALLING_PROMPT
+        return f"Tools: {json.dumps(specs, indent=2)}" + instructions
+
+    def system_prompt_for(
+        self,
+        tool_names: Optional[List[str]] = None,
+        mode: str = "full",
+        structured: bool = False,
+    ) -> str:
+        """
+        Returns the function calling system prompt restricted to some tools.
+        :param tool_names: The tools to describe, all of them if None.
+        :param mode: "full" describes the tools with their indented JSON specs, "compact" with one signature per tool.
+        :param structured: Whether the answer is constrained to the schema of schema_for.
+        :return: The cached system prompt.
+        """
+        if tool_names is None and mode == "full" and not structured:
+            return self.system_prompt
+        names = tuple(sorted(tool_names)) if tool_names is not None else None
+        key = (mode, names, structured)
+        prompt = self._prompts.get(key)
+        if prompt is None:
+            prompt = self._prompts[key] = self.build_system_prompt(
+                [spec for spec in self.specs if names is None or spec["name"] in names],
+                mode,
+                structured,
+            )
+        return prompt
+
+    def schema_for(self, tool_names: Optional[List[str]] = None) -> dict:
+        """
+        Returns the JSON schema of the task model answer, restricted to some tools.
+        :param tool_names: The tools that can be called, all of them if None.
+        :return: The cached schema.
+        """
+        names = tuple(sorted(tool_names)) if tool_names is not None else None
+        schema = self._schemas.get(names)
+        if schema is None:
+            schema = self._schemas[names] = tool_calls_schema(
+                [spec for spec in self.specs if names is None or spec["name"] in names]
+            )
+        return schema
+
+    def invalidate(self):
+        self._tools_class = None
+        self._valves = None
 
 
 class Pipeline:
@@ -156,6 +431,84 @@ class Pipeline:
         TASK_MODEL: str
         TEMPLATE: str
 
+        # Valves for the HTTP client used to call the task model
+        TASK_MODEL_TIMEOUT: float = 60.0
+        TASK_MODEL_CONNECT_TIMEOUT: float = 5.0
+        HTTP_MAX_CONNECTIONS: int = 20
+        HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 10
+        HTTP_KEEPALIVE_EXPIRY: float = 30.0
+
+        # Valves for the cache of the function calling decisions of the task model
+        DECISION_CACHE_TTL: float = 600.0
+        DECISION_CACHE_SIZE: int = 1024
+        # Number of previous messages, besides the query, that the cached decision depends on
+        DECISION_CACHE_HISTORY: int = 2
+
+        # Valves for the local tool router, which scores the tools against the query with BM25.
+        # "off" disables it, "shadow" only logs its decisions next to the task model ones,
+        # "on" skips function calling below ROUTER_SKIP_THRESHOLD, calls the best tool directly
+        # from ROUTER_DIRECT_THRESHOLD and otherwise sends only the ROUTER_TOP_K best tools to the task model.
+        ROUTER_MODE: Literal["off", "shadow", "on"] = "shadow"
+        ROUTER_SKIP_THRESHOLD: float = 0.5
+        ROUTER_DIRECT_THRESHOLD: float = 2.0
+        ROUTER_TOP_K: int = 2
+
+        # Valves for the function calling prompt sent to the task model.
+        # "full" sends the indented JSON tool specs and the last HISTORY_MESSAGES messages as they are,
+        # "compact" sends one signature per tool and the previous non-system messages cut at HISTORY_MAX_CHARS.
+        PROMPT_MODE: Literal["full", "compact"] = "full"
+        HISTORY_MESSAGES: int = 4
+        HISTORY_MAX_CHARS: int = 500
+
+        # Valves for the generation of the task model. STRUCTURED_OUTPUT constrains its answer to
+        # the JSON schema of the tool calls through the Ollama "format" field (Ollama 0.5 or later).
+        STRUCTURED_OUTPUT: bool = True
+        TASK_MODEL_NUM_PREDICT: int = 256
+        TASK_MODEL_TEMPERATURE: float = 0.0
+        # How long Ollama keeps the task model loaded after a call: a duration such as "30m" or "24h",
+        # or a number of seconds, "-1" keeping it loaded for ever (numbers are sent as JSON numbers)
+        TASK_MODEL_KEEP_ALIVE: str = "30m"
+
+        # Maximum size in characters of the tool context injected in the system message
+        INJECTED_CONTEXT_MAX_CHARS: int = 12000
+
+        # Seconds a tool call may run, unless the tool declares its own timeout with tool_timeout
+        TOOL_TIMEOUT: float = 30.0
+        # Threads running the sync tools, and processes running their CPU-bound work (0 keeps it in the tool thread)
+        TOOL_THREAD_POOL_SIZE: int = 8
+        TOOL_PROCESS_POOL_SIZE: int = 2
+
+        # Valves for the HTTP requests of the tools: timeout of each attempt, retries with capped
+        # exponential backoff, and per-host circuit breakers opening after consecutive failures
+        TOOL_HTTP_TIMEOUT: float = 10.0
+        TOOL_HTTP_RETRIES: int = 2
+        TOOL_HTTP_BACKOFF_BASE: float = 0.5
+        TOOL_HTTP_BACKOFF_MAX: float = 8.0
+        TOOL_HTTP_BREAKER_THRESHOLD: int = 5
+        TOOL_HTTP_BREAKER_RESET: float = 30.0
+
+        # Valves for speculative tool calls: a tool marked with speculative_tool whose router score
+        # reaches SPECULATIVE_THRESHOLD starts with provisional parameters while the task model decides
+        SPECULATIVE_MODE: bool = False
+        SPECULATIVE_THRESHOLD: float = 1.0
+
+        # Valves for the admission of the requests: token buckets per user id and for all the users,
+        # refilled at the given rate per minute (0 disables a limit), and a task model latency, as the
+        # mean of the calls of the last SHED_LATENCY_WINDOW seconds, above which requests are shed
+        # (0 disables it). Shedding needs SHED_MIN_SAMPLES calls in the window, so that one slow call,
+        # e.g. a cold model load, does not shed everyone. A request over a limit skips function calling
+        # and its body passes unchanged.
+        RATE_LIMIT_USER_PER_MINUTE: float = 20.0
+        RATE_LIMIT_USER_BURST: int = 10
+        RATE_LIMIT_GLOBAL_PER_MINUTE: float = 300.0
+        RATE_LIMIT_GLOBAL_BURST: int = 50
+        SHED_TASK_MODEL_LATENCY: float = 10.0
+        SHED_LATENCY_WINDOW: float = 30.0
+        SHED_MIN_SAMPLES: int = 5
+
+        # Level of the pipeline logs, DEBUG also logs the request bodies and the prompts
+        LOG_LEVEL: Literal["DEBUG", "INFO", "WARNING", "ERROR"] = "INFO"
+
     def __init__(self):
         # Pipeline filters are only compatible with Open WebUI
         # You can think of filter pipeline as a middleware that can be used to edit the form data before it is sent to the OpenAI API.
@@ -190,124 +543,650 @@ And answer according to the language of the user's question.""",
             }
         )
 
+        # Tool specs and function calling prompt, built once and reused across requests
+        self.tool_registry = ToolRegistry()
+
+        # Tool results memoized according to the cached_tool policy of each tool
+        self.tool_cache = ToolResultCache()
+
+        # Function calling decisions of the task model, including "no function"
+        self.decision_cache = TTLCache(
+            maxsize=self.valves.DECISION_CACHE_SIZE, ttl=self.valves.DECISION_CACHE_TTL
+        )
+
+        # Decode time and output tokens of the task model calls
+        self.task_model_stats = {
+            "calls": 0,
+            "output_tokens": 0,
+            "decode_seconds": 0.0,
+            "prompt_tokens": 0,
+            "prompt_seconds": 0.0,
+        }
+
+        # HTTP client of the tools, with retries and circuit breakers
+        self.tool_http = self.create_tool_http()
+
+        # Speculative tool calls started, confirmed by the task model, warming the caches of its call, and cancelled
+        self.speculation_stats = {"started": 0, "hits": 0, "warmed": 0, "wasted": 0}
+
+        # Admission of the requests: rate limits, recent task model latency, and shed requests by reason
+        self.rate_limiter: Optional[RateLimiter] = None
+        self.task_model_latency = LatencyWindow(self.valves.SHED_LATENCY_WINDOW)
+        self.shed_stats = {"user": 0, "global": 0, "latency": 0}
+
+        # Pooled async HTTP client, created in on_startup and closed in on_shutdown, with the
+        # settings it was created with and the requests in flight on each client still in use
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.http_client_settings: Optional[tuple] = None
+        self.http_client_requests: Dict[httpx.AsyncClient, int] = {}
+
+        # Runs the tools off the event loop, its pools are created on first use
+        self.tool_executor = ToolExecutor(
+            self.valves.TOOL_THREAD_POOL_SIZE, self.valves.TOOL_PROCESS_POOL_SIZE
+        )
+
     async def on_startup(self):
         # This function is called when the server is started.
-        print(f"on_startup:{__name__}")
-        pass
+        configure_logging(self.valves.LOG_LEVEL, type(self).__module__)
+        logger.info("on_startup:%s", __name__)
+        self.get_http_client()
+        if hasattr(self, "tools"):
+            self.tool_registry.get(self.tools, self.valves)
 
     async def on_shutdown(self):
         # This function is called when the server is stopped.
-        print(f"on_shutdown:{__name__}")
-        pass
+        logger.info("on_shutdown:%s", __name__)
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+        self.tool_executor.shutdown()
+        self.tool_http.close()
 
+    async def on_valves_updated(self):
+        # This function is called when the valves are updated.
+        configure_logging(self.valves.LOG_LEVEL, type(self).__module__)
+        self.tool_registry.invalidate()
+        self.tool_cache.clear()
+        self.decision_cache.clear()
+
+        # New timeouts and limits need a new HTTP client. The requests in flight finish on the
+        # old one, closed by release_http_client after the last of them.
+        if self.http_client is not None and self.http_client_settings != self.get_http_client_settings():
+            client, self.http_client = self.http_client, None
+            if not self.http_client_requests.get(client):
+                await client.aclose()
+        self.get_http_client()
+
+        # Resize the tool pools, running and queued calls finish on the old ones
+        self.tool_executor.shutdown(cancel_futures=False)
+        self.tool_executor = ToolExecutor(
+            self.valves.TOOL_THREAD_POOL_SIZE, self.valves.TOOL_PROCESS_POOL_SIZE
+        )
+
+        # New retry and breaker settings, the breakers start closed again
+        self.tool_http.close()
+        self.tool_http = self.create_tool_http()
+
+    def create_tool_http(self) -> ResilientHTTP:
+        return ResilientHTTP(
+            timeout=self.valves.TOOL_HTTP_TIMEOUT,
+            retries=self.valves.TOOL_HTTP_RETRIES,
+            backoff_base=self.valves.TOOL_HTTP_BACKOFF_BASE,
+            backoff_max=self.valves.TOOL_HTTP_BACKOFF_MAX,
+            failure_threshold=self.valves.TOOL_HTTP_BREAKER_THRESHOLD,
+            reset_timeout=self.valves.TOOL_HTTP_BREAKER_RESET,
+            pool_size=self.tool_http_pool_size(),
+        )
+
+    def tool_http_pool_size(self) -> int:
+        """
+        Returns the connections kept per host by the tool HTTP client, enough for every tool thread.
+        Pipelines whose tools send concurrent requests from each thread should multiply it.
+        """
+        return max(1, self.valves.TOOL_THREAD_POOL_SIZE)
+
+    def get_rate_limiter(self) -> RateLimiter:
+        """
+        Returns the rate limiter configured by the valves, a new one if they changed.
+        :return: The rate limiter.
+        """
+        limits = (
+            self.valves.RATE_LIMIT_USER_PER_MINUTE / 60,
+            self.valves.RATE_LIMIT_USER_BURST,
+            self.valves.RATE_LIMIT_GLOBAL_PER_MINUTE / 60,
+            self.valves.RATE_LIMIT_GLOBAL_BURST,
+        )
+        if self.rate_limiter is None or self.rate_limiter.limits != limits:
+            self.rate_limiter = RateLimiter(*limits)
+        return self.rate_limiter
+
+    def get_http_client(self) -> httpx.AsyncClient:
+        """
+        Returns the pooled keep-alive HTTP client, creating it if needed.
+        :return: The async HTTP client shared by all requests.
+        """
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client_settings = self.get_http_client_settings()
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    self.valves.TASK_MODEL_TIMEOUT,
+                    connect=self.valves.TASK_MODEL_CONNECT_TIMEOUT,
+                ),
+                limits=httpx.Limits(
+                    max_connections=self.valves.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=self.valves.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=self.valves.HTTP_KEEPALIVE_EXPIRY,
+                ),
+            )
+        return self.http_client
+
+    def get_http_client_settings(self) -> tuple:
+        return (
+            self.valves.TASK_MODEL_TIMEOUT,
+            self.valves.TASK_MODEL_CONNECT_TIMEOUT,
+            self.valves.HTTP_MAX_CONNECTIONS,
+            self.valves.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            self.valves.HTTP_KEEPALIVE_EXPIRY,
+        )
+
+    def acquire_http_client(self) -> httpx.AsyncClient:
+        """
+        Returns the HTTP client for a request, which must then be released with release_http_client.
+        """
+        client = self.get_http_client()
+        self.http_client_requests[client] = self.http_client_requests.get(client, 0) + 1
+        return client
+
+    async def release_http_client(self, client: httpx.AsyncClient):
+        """
+        Ends a request on a client, closing the client if it was replaced and this was its last request.
+        """
+        requests = self.http_client_requests.pop(client, 1) - 1
+        if requests:
+            self.http_client_requests[client] = requests
+        elif client is not self.http_client and not client.is_closed:
+            await client.aclose()
+
+    def metrics(self) -> dict:
+        """
+        Returns the stage latencies, the counters and the cache statistics of the process.
+        """
+        return {
+            **metrics.snapshot(),
+            "decision_cache": self.decision_cache.stats(),
+            "tool_cache": self.tool_cache.stats(),
+            "task_model": dict(self.task_model_stats),
+            "speculation": self.speculation_rates(),
+            "circuit_breakers": self.tool_http.stats(),
+            "load_shedding": self.shedding_stats(),
+        }
+
+    def speculation_rates(self) -> dict:
+        stats = self.speculation_stats
+        started = stats["started"]
+        return {
+            **stats,
+            "hit_rate": stats["hits"] / started if started else 0.0,
+            "warm_rate": stats["warmed"] / started if started else 0.0,
+            "waste_rate": stats["wasted"] / started if started else 0.0,
+        }
+
+    def shedding_stats(self) -> dict:
+        return {
+            "shed": dict(self.shed_stats),
+            "task_model_latency": self.task_model_latency.mean(),
+            "task_model_calls": len(self.task_model_latency.samples),
+            "shedding": self.task_model_overloaded(),
+        }
+
+    def metrics_text(self) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        cache = metrics.gauge("cache_stat", "Statistics of the in-memory caches.")
+        for name, value in self.decision_cache.stats().items():
+            cache.set(value, cache="decision", stat=name)
+        for tool, stats in self.tool_cache.stats().items():
+            for name, value in stats.items():
+                cache.set(value, cache=f"tool:{tool}", stat=name)
+        return metrics.render_prometheus()
 
-    
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         # If title generation is requested, skip the function calling filter
         if body.get("title", False):
             return body
-        print(f"This is the body: {body}")
-        print(f"Those are the messages: {body['messages']}")
-        print(f"pipe: {__name__}")
-        print("User Information:", user)
-        
+
+        reason = self.admit(user)
+        if reason is not None:
+            self.shed_stats[reason] += 1
+            metrics.counter("function_calling_shed_total", "Requests passed through without function calling.").inc(
+                reason=reason
+            )
+            metrics.counter("function_calling_requests_total", "Requests by outcome.").inc(outcome="shed")
+            logger.warning("Function calling skipped for user %s: %s", (user or {}).get("id"), reason)
+            return body
+
+        with metrics.span("inlet"):
+            body, outcome = await self.apply_tools(body, user)
+        metrics.counter("function_calling_requests_total", "Requests by outcome.").inc(
+            outcome=outcome
+        )
+        return body
+
+    def task_model_overloaded(self) -> bool:
+        threshold = self.valves.SHED_TASK_MODEL_LATENCY
+        if not threshold:
+            return False
+        latency = self.task_model_latency.mean(max(1, self.valves.SHED_MIN_SAMPLES))
+        return latency is not None and latency > threshold
+
+    def admit(self, user: Optional[dict] = None) -> Optional[str]:
+        """
+        Decides whether a request may use function calling, without waiting.
+        :param user: The Open WebUI user, its id keys the per user rate limit.
+        :return: None if the request is admitted, otherwise why it is shed: "latency", "user" or "global".
+        """
+        self.task_model_latency.window = self.valves.SHED_LATENCY_WINDOW
+        if self.task_model_overloaded():
+            return "latency"
+        return self.get_rate_limiter().acquire((user or {}).get("id", "anonymous"))
+
+    async def apply_tools(self, body: dict, user: Optional[dict] = None):
+        """
+        Calls the tools the request needs and injects their results in the system prompt.
+        :return: The body to forward and the outcome of the request: "skipped", "no_tool", "no_result", "injected" or "error".
+        """
+        logger.debug("pipe: %s, user: %s, body: %s", __name__, LazyJson(user), LazyJson(body))
+
         # Get the last user message
-        print("Going to get the last user message...")
         user_message = get_last_user_message(body["messages"])
-        print("Last user message is:", user_message)
-        # Get the tools specs
-        print("Going to get the tools specs...")
-        tools_specs = get_tools_specs(self.tools)
-        print("Tools specs are:", tools_specs)
-
-        # System prompt for function calling
-        print("Going to set the system prompt...")
-        fc_system_prompt = (
-            f"Tools: {json.dumps(tools_specs, indent=2)}"
-            + """
-If a function tool doesn't match the query, return an empty string. Else, pick a function tool, fill in the parameters from the function tool's schema, and return it in the format { "name": \"functionName\", "parameters": { "key": "value" } }. Only pick a function if the user asks.  Only return the object. Do not return any other text."
-"""
+        logger.debug("Last user message is: %s", user_message)
+        # Get the tools specs and the system prompt for function calling
+        registry = self.tool_registry.get(self.tools, self.valves)
+
+        speculation = None
+        try:
+            route = None
+            if self.valves.ROUTER_MODE != "off":
+                route = registry.router.route(
+                    user_message,
+                    self.valves.ROUTER_SKIP_THRESHOLD,
+                    self.valves.ROUTER_DIRECT_THRESHOLD,
+                    self.valves.ROUTER_TOP_K,
+                )
+
+            if self.valves.ROUTER_MODE == "on" and route.action == "skip":
+                self.log_route(user_message, route, [])
+                return body, "skipped"
+            elif self.valves.ROUTER_MODE == "on" and route.action == "direct":
+                calls = [route.call]
+            else:
+                tool_names = route.tool_names if self.valves.ROUTER_MODE == "on" else None
+                speculation = self.start_speculation(user_message, route, registry)
+                calls = await self.get_function_calls(
+                    body["messages"], user_message, registry, tool_names
+                )
+            if route is not None:
+                self.log_route(user_message, route, calls)
+
+            if not calls:
+                return body, "no_tool"
+
+            # Call the functions
+            results = await self.run_tool_calls(calls, registry, speculation)
+            function_result = format_tool_results(results)
+            if not function_result:
+                return body, "no_result"
+
+            # Add the function results to the system prompt, cutting the context rather than the template
+            with metrics.span("prompt_injection"):
+                budget = self.valves.INJECTED_CONTEXT_MAX_CHARS
+                if budget > 0:
+                    overhead = len(self.valves.TEMPLATE) - len("{{CONTEXT}}")
+                    if overhead < budget:
+                        function_result = truncate_text(function_result, budget - overhead)
+                    else:
+                        # The template alone exceeds the budget: keep it whole and only cap the results
+                        logger.warning(
+                            "TEMPLATE is longer than INJECTED_CONTEXT_MAX_CHARS (%d >= %d)", overhead, budget
+                        )
+                        function_result = truncate_text(function_result, budget)
+                        budget = 0
+                system_prompt = self.valves.TEMPLATE.replace(
+                    "{{CONTEXT}}", function_result
+                )
+                messages = add_or_update_system_message(system_prompt, body["messages"], budget)
+            logger.debug("System prompt: %s", system_prompt)
+
+            # Return the updated messages
+            return {**body, "messages": messages}, "injected"
+
+        except Exception:
+            logger.exception("Function calling failed")
+            return body, "error"
+        finally:
+            if speculation is not None:
+                self.settle_speculation(speculation)
+
+    def start_speculation(
+        self, user_message: str, route: Optional[RouteDecision], registry: ToolRegistry
+    ) -> Optional[Speculation]:
+        """
+        Starts the most likely slow tool with provisional parameters, if the router score
+        of a tool marked with speculative_tool reaches SPECULATIVE_THRESHOLD.
+        :param user_message: The last user message.
+        :param route: The routing decision, if the router is enabled.
+        :param registry: The tool registry.
+        :return: The running speculative call, or None.
+        """
+        if not self.valves.SPECULATIVE_MODE or not registry.speculative:
+            return None
+        candidates = route.candidates if route is not None else registry.router.score(user_message or "")
+        for name, score in candidates:
+            if score < self.valves.SPECULATIVE_THRESHOLD:
+                break
+            arguments = registry.speculative.get(name)
+            if arguments is None:
+                continue
+            try:
+                parameters = arguments(user_message or "")
+            except Exception as e:
+                logger.warning("Provisional parameters of %s failed: %s", name, e)
+                continue
+            if not parameters:
+                continue
+            call = {"name": name, "parameters": parameters}
+            task = asyncio.create_task(self.run_tool_calls([call], registry))
+            self.speculation_stats["started"] += 1
+            logger.info("Speculative call: %s", name)
+            logger.debug("Speculative call parameters: %s", LazyJson(parameters))
+            return Speculation(call, task)
+        return None
+
+    def settle_speculation(self, speculation: Speculation):
+        """
+        Counts a speculative call as a hit if the task model confirmed it, as warmed if it only
+        warmed the caches of the confirmed call, otherwise cancels it.
+        """
+        if speculation.settled:
+            return
+        speculation.settled = True
+        if speculation.used:
+            outcome = "hit"
+            self.speculation_stats["hits"] += 1
+        elif speculation.warmed:
+            outcome = "warmed"
+            self.speculation_stats["warmed"] += 1
+        else:
+            outcome = "wasted"
+            self.speculation_stats["wasted"] += 1
+            speculation.task.cancel()
+        metrics.counter("speculative_calls_total", "Speculative tool calls by outcome.").inc(
+            tool=speculation.call["name"], outcome=outcome
+        )
+
+    async def run_tool_calls(
+        self,
+        calls: List[dict],
+        registry: ToolRegistry,
+        speculation: Optional[Speculation] = None,
+    ) -> List[ToolCallResult]:
+        """
+        Runs the function calls concurrently, each within its timeout.
+        A failed call does not affect the others. If the request is cancelled,
+        for instance because the client went away, the running tools are told to stop.
+        :param calls: The function calls.
+        :param registry: The tool registry, only its tools can be called.
+        :param speculation: A call already started before the task model answered, reused if one of the calls matches it.
+        :return: The result or error of each call, in the same order. Calls merged by batched_tool have one result.
+        """
+        names = {spec["name"] for spec in registry.specs}
+        # A call matching the speculative call runs on its own, to use or wait for the prefetch
+        calls = merge_batched_calls(
+            calls,
+            lambda name: getattr(self.tools, name, None) if name in names else None,
+            keep=(
+                lambda call, function: speculation.matches(call, function, warm=True)
+                or speculation.matches(call, function)
+            )
+            if speculation is not None
+            else None,
+        )
+
+        async def run(call: dict) -> ToolCallResult:
+            if call["name"] not in names:
+                return ToolCallResult(call, error=LookupError(f"Unknown function {call['name']}"))
+            function = getattr(self.tools, call["name"])
+            if speculation is not None and speculation.claim(call, function):
+                (prefetched,) = await speculation.task
+                return ToolCallResult(call, prefetched.result, prefetched.error)
+            if speculation is not None and speculation.warms(call, function):
+                # The call itself then finds what the prefetch fetched in the tool caches
+                await asyncio.wait([speculation.task])
+            timeout = getattr(function, "__tool_timeout__", self.valves.TOOL_TIMEOUT)
+            # Async tools are awaited on the loop, sync tools run in the thread pool
+            cached_call = (
+                self.tool_cache.acall
+                if inspect.iscoroutinefunction(function)
+                else self.tool_cache.call
+            )
+            try:
+                with metrics.span("tool_execution", tool=call["name"]):
+                    result = await self.tool_executor.run(
+                        cached_call, call["name"], function, call["parameters"], timeout=timeout
+                    )
+                return ToolCallResult(call, result)
+            except asyncio.TimeoutError:
+                return ToolCallResult(call, error=TimeoutError(f"{call['name']} timed out after {timeout}s"))
+            except Exception as e:
+                return ToolCallResult(call, error=e)
+
+        results = await asyncio.gather(*[run(call) for call in calls])
+        for result in results:
+            if result.error is not None:
+                logger.warning("Function %s failed: %s", result.call["name"], result.error)
+        return list(results)
+
+    def log_route(self, user_message: str, route: RouteDecision, calls: List[dict]):
+        # One JSON line per routed request, to compare the router with the task model offline.
+        # The query and the call parameters are request content, only logged at DEBUG.
+        entry = {
+            "mode": self.valves.ROUTER_MODE,
+            "route": route.to_dict(),
+            "functions": [call["name"] for call in calls],
+        }
+        if logger.isEnabledFor(logging.DEBUG):
+            entry["query"] = user_message
+            logger.debug("Tool routing: %s", LazyJson(entry))
+        else:
+            entry["route"].pop("call")
+            logger.info("Tool routing: %s", LazyJson(entry))
+
+    def decision_key(
+        self,
+        messages: List[dict],
+        user_message: str,
+        registry: ToolRegistry,
+        tool_names: Optional[List[str]] = None,
+    ) -> str:
+        """
+        Builds the decision cache key of a request.
+        :param messages: The messages of the request.
+        :param user_message: The last user message.
+        :param registry: The tool registry, its hash invalidates decisions taken with other tools.
+        :param tool_names: The tools offered to the task model, all of them if None.
+        :return: The cache key.
+        """
+        history = []
+        if self.valves.DECISION_CACHE_HISTORY > 0:
+            history = [
+                message for message in messages[:-1] if message.get("role") != "system"
+            ][-self.valves.DECISION_CACHE_HISTORY:]
+        key = {
+            "model": self.valves.TASK_MODEL,
+            "tools": registry.hash,
+            "candidates": sorted(tool_names) if tool_names is not None else None,
+            "prompt": self.valves.PROMPT_MODE,
+            "structured": self.valves.STRUCTURED_OUTPUT,
+            "query": normalize_query(user_message or ""),
+            "history": [
+                [message["role"], normalize_query(str(message["content"]))]
+                for message in history
+            ],
+        }
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    async def get_function_calls(
+        self,
+        messages: List[dict],
+        user_message: str,
+        registry: ToolRegistry,
+        tool_names: Optional[List[str]] = None,
+    ) -> List[dict]:
+        """
+        Asks the task model which functions to call, reusing the cached decision of identical requests.
+        :param messages: The messages of the request.
+        :param user_message: The last user message.
+        :param registry: The tool registry.
+        :param tool_names: The tools offered to the task model, all of them if None.
+        :return: The function calls as { "name": ..., "parameters": ... }, empty if no function matches.
+        """
+        key = self.decision_key(messages, user_message, registry, tool_names)
+        self.decision_cache.maxsize = self.valves.DECISION_CACHE_SIZE
+        calls = self.decision_cache.get(key, MISSING)
+        if calls is not MISSING:
+            logger.info("Function call decision from cache: %s", [call["name"] for call in calls])
+            logger.debug("Cached function calls: %s", LazyJson(calls))
+            return calls
+
+        calls = await self.call_task_model(messages, user_message, registry, tool_names)
+        self.decision_cache.set(key, calls, ttl=self.valves.DECISION_CACHE_TTL)
+        return calls
+
+    def build_history_prompt(self, messages: List[dict], user_message: str) -> str:
+        """
+        Builds the user message of the function calling request from the conversation.
+        :param messages: The messages of the request.
+        :param user_message: The last user message.
+        :return: The history followed by the query.
+        """
+        count = max(0, self.valves.HISTORY_MESSAGES)
+        if self.valves.PROMPT_MODE == "compact":
+            # Oldest first, without system messages (they may carry previously injected context)
+            # and without the last user message, which is the query
+            history = [message for message in messages if message.get("role") != "system"]
+            if history and history[-1].get("role") == "user":
+                history = history[:-1]
+            history = history[-count:] if count else []
+            lines = [
+                f"{message['role']}: {truncate_text(' '.join(get_message_text(message).split()), self.valves.HISTORY_MAX_CHARS)}"
+                for message in history
+            ]
+            query = truncate_text(user_message or "", self.valves.HISTORY_MAX_CHARS * 2)
+            return ("History:\n" + "\n".join(lines) + "\n" if lines else "") + f"Query: {query}"
+
+        return (
+            "History:\n"
+            + "\n".join(
+                [
+                    f"{message['role']}: {strip_tool_context(get_message_text(message))}"
+                    for message in messages[::-1][:count]
+                ]
+            )
+            + f"\nQuery: {user_message}"
+        )
+
+    def record_task_model_call(self, response: dict):
+        """
+        Adds the token counts and durations reported by Ollama to the task model stats.
+        :param response: The /api/chat response.
+        """
+        # Ollama reports durations in nanoseconds
+        call = {
+            "output_tokens": response.get("eval_count", 0),
+            "decode_seconds": response.get("eval_duration", 0) / 1e9,
+            "prompt_tokens": response.get("prompt_eval_count", 0),
+            "prompt_seconds": response.get("prompt_eval_duration", 0) / 1e9,
+        }
+        self.task_model_stats["calls"] += 1
+        for name, value in call.items():
+            self.task_model_stats[name] += value
+        metrics.counter("task_model_output_tokens_total", "Tokens generated by the task model.").inc(
+            call["output_tokens"]
+        )
+        metrics.histogram("task_model_decode_seconds", "Decode time of the task model answers.").observe(
+            call["decode_seconds"]
+        )
+        logger.info("Task model call: %s", LazyJson(call))
+
+    async def call_task_model(
+        self,
+        messages: List[dict],
+        user_message: str,
+        registry: ToolRegistry,
+        tool_names: Optional[List[str]] = None,
+    ) -> List[dict]:
+        structured = self.valves.STRUCTURED_OUTPUT
+        fc_system_prompt = registry.system_prompt_for(
+            tool_names, self.valves.PROMPT_MODE, structured
         )
-        print("system Prompt seeted as follow: ", fc_system_prompt)
         r = None
         try:
             # Costruzione dei messaggi per la richiesta
-            messages = [
+            fc_messages = [
                 {
                     "role": "system",
                     "content": fc_system_prompt,
                 },
                 {
                     "role": "user",
-                    "content": "History:\n"
-                    + "\n".join(
-                        [
-                            f"{message['role']}: {message['content']}"
-                            for message in body["messages"][::-1][:4]
-                        ]
-                    )
-                    + f"\nQuery: {user_message}",
+                    "content": self.build_history_prompt(messages, user_message),
                 },
             ]
-            # Stampa dei messaggi per il debug
-            print("Request JSON:", json.dumps({
+            payload = {
                 "model": self.valves.TASK_MODEL,
-                "messages": messages,
-                "stream": False
-            }, indent=4))
-            # Call the OpenAI API to get the function response
-            print("making the post request to llm...")
-            r = requests.post(
-                url=f"{self.valves.OLLAMA_API_BASE_URL}/api/chat",
-                json={
-                    "model": self.valves.TASK_MODEL,
-                    "messages": messages,
-                    "stream": False
-                },
-                headers={
-                    "Authorization": f"Bearer {self.valves.OLLAMA_API_KEY}",
-                    "Content-Type": "application/json",
+                "messages": fc_messages,
+                "stream": False,
+                "keep_alive": keep_alive_value(self.valves.TASK_MODEL_KEEP_ALIVE),
+                "options": {
+                    "temperature": self.valves.TASK_MODEL_TEMPERATURE,
+                    "num_predict": self.valves.TASK_MODEL_NUM_PREDICT,
                 },
-            )
-            r.raise_for_status()
-            response = r.json()
+            }
+            if structured:
+                payload["format"] = registry.schema_for(tool_names)
+            # Stampa dei messaggi per il debug
+            logger.debug("Request JSON: %s", LazyJson(payload))
+            # Call the OpenAI API to get the function response
+            start = time.perf_counter()
+            client = self.acquire_http_client()
+            try:
+                with metrics.span("task_model", model=self.valves.TASK_MODEL):
+                    r = await client.post(
+                        url=f"{self.valves.OLLAMA_API_BASE_URL}/api/chat",
+                        json=payload,
+                        headers={
+                            "Authorization": f"Bearer {self.valves.OLLAMA_API_KEY}",
+                            "Content-Type": "application/json",
+                        },
+                    )
+                    r.raise_for_status()
+                    response = r.json()
+            finally:
+                # Failed and timed out calls count too, a struggling task model must shed load
+                self.task_model_latency.observe(time.perf_counter() - start)
+                await self.release_http_client(client)
             content = response["message"]["content"]
+            self.record_task_model_call(response)
 
             # Parse the function response
-            if content != "":
-                result = json.loads(content)
-                print(result)
-
-                # Call the function
-                if "name" in result:
-                    function = getattr(self.tools, result["name"])
-                    function_result = None
-                    try:
-                        function_result = function(**result["parameters"])
-                    except Exception as e:
-                        print(e)
-
-                    # Add the function result to the system prompt
-                    if function_result:
-                        system_prompt = self.valves.TEMPLATE.replace(
-                            "{{CONTEXT}}", function_result
-                        )
-
-                        print(system_prompt)
-                        messages = add_or_update_system_message(
-                            system_prompt, body["messages"]
-                        )
+            with metrics.span("json_parse"):
+                calls = parse_function_calls(content)
+            logger.info("Function calls: %s", [call["name"] for call in calls])
+            logger.debug("Function call parameters: %s", LazyJson(calls))
+            return calls
 
-                        # Return the updated messages
-                        return {**body, "messages": messages}
-
-        except Exception as e:
-            print(f"Error: {e}")
-
-            if r:
-                try:
-                    print(r.json())
-                except:
-                    pass
-
-        return body
+        except Exception:
+            if r is not None:
+                logger.error("Task model response: %s", r.text)
+            raise
@@ -0,0 +1,245 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from contextlib import contextmanager
+import bisect
+import json
+import logging
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class LazyJson:
+    """
+    Serializes a value to JSON only when the log record is actually emitted.
+
+    Example:
+        logger.debug("Request %s", LazyJson(payload))
+    """
+
+    def __init__(self, value, **kwargs):
+        self.value = value
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, default=str, **self.kwargs)
+
+
+def configure_logging(level: str, *names: str):
+    """
+    Sets the level of the blueprints and pipelines loggers, adding a stderr handler
+    if the server did not configure logging.
+    :param level: A logging level name, e.g. "INFO" or "DEBUG".
+    :param names: Other loggers to set, e.g. the module of a pipeline loaded from a file.
+    """
+    numeric = logging.getLevelName(level.upper())
+    if not isinstance(numeric, int):
+        numeric = logging.INFO
+    for name in ("blueprints", "pipelines", *names):
+        logging.getLogger(name).setLevel(numeric)
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+
+def _labels_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: Iterable[Tuple[str, str]], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self.values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [bucket counts (+Inf last), sum, count]
+        self.values: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """
+        Estimates a quantile from the buckets, as the upper bound of the bucket that holds it.
+        :param q: The quantile, between 0 and 1.
+        :return: The estimate in seconds, None without observations.
+        """
+        with self._lock:
+            entry = self.values.get(_labels_key(labels))
+            if entry is None or not entry[2]:
+                return None
+            counts, _, count = entry[0][:], entry[1], entry[2]
+        rank, cumulative = q * count, 0
+        for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            entries = [(key, entry[0][:], entry[1], entry[2]) for key, entry in self.values.items()]
+        return [
+            {
+                "labels": dict(key),
+                "count": count,
+                "sum": total,
+                "mean": total / count if count else 0.0,
+                "buckets": dict(zip([*map(str, self.buckets), "+Inf"], counts)),
+            }
+            for key, counts, total, count in entries
+        ]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            entries = [(key, entry[0][:], entry[1], entry[2]) for key, entry in self.values.items()]
+        for key, counts, total, count in entries:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                labels = _format_labels(key, ("le", _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total!r}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Holds the counters, gauges and histograms of the process, and renders them
+    as a Python dict or in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "", buckets: Iterable[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """
+        Times a block into the pipeline_stage_duration_seconds histogram and counts its failures.
+
+        Example:
+            with metrics.span("task_model"):
+                response = await client.post(...)
+
+        :param stage: The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.counter("pipeline_stage_errors_total", "Failed stage executions.").inc(
+                stage=stage, error=type(e).__name__, **labels
+            )
+            raise
+        finally:
+            self.histogram("pipeline_stage_duration_seconds", "Duration of the pipeline stages.").observe(
+                time.perf_counter() - start, stage=stage, **labels
+            )
+
+    def snapshot(self) -> Dict[str, List[dict]]:
+        """
+        Returns every metric as a list of label sets with their values.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render_prometheus(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+# Process wide registry, shared by the pipelines and their tools
+metrics = MetricsRegistry()
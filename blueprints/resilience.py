@@ -0,0 +1,349 @@
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+from collections import deque
+from concurrent.futures import CancelledError
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from blueprints.caching import TTLCache
+from blueprints.metrics import metrics
+from blueprints.tool_execution import current_cancel_event
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: rate limiting and transient upstream failures
+RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# Values of the circuit_breaker_state gauge
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling the upstream while its circuit breaker is open.
+    """
+
+
+class RetriesExhaustedError(Exception):
+    """
+    Raised when every attempt of a request failed.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and then fails fast for reset_timeout
+    seconds. After that a single trial request is let through (half open): its success closes
+    the breaker, its failure opens it again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning("Circuit breaker %s: %s -> %s", self.name, self.state, state)
+            if state == "open":
+                metrics.counter("circuit_breaker_opened_total", "Times a circuit breaker opened.").inc(host=self.name)
+        self.state = state
+        metrics.gauge("circuit_breaker_state", "Circuit breaker state: 0 closed, 1 half open, 2 open.").set(
+            BREAKER_STATES[state], host=self.name
+        )
+
+    def allow(self):
+        """
+        Raises CircuitOpenError if a request must not be sent now.
+        """
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"{self.name} is unavailable, circuit breaker open")
+                self._set_state("half_open")
+            if self.state == "half_open":
+                if self._trial:
+                    raise CircuitOpenError(f"{self.name} is unavailable, circuit breaker half open")
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set_state("closed")
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures}
+
+
+def retry_after(response: requests.Response) -> Optional[float]:
+    """
+    Returns the delay in seconds asked by a Retry-After header, as seconds or as an HTTP date.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ResilientHTTP:
+    """
+    Pooled HTTP client for the tools: every request has a timeout, transient failures are
+    retried with capped exponential backoff and full jitter (or the delay of Retry-After),
+    and a circuit breaker per host fails fast while an upstream is unhealthy.
+    """
+
+    def __init__(
+        self,
+        timeout: float = 10.0,
+        retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        pool_size: int = 16,
+    ):
+        """
+        :param timeout: The default connect and read timeout of a request in seconds.
+        :param retries: The number of retries after the first attempt.
+        :param backoff_base: The backoff before the first retry, doubled for every other one.
+        :param backoff_max: The cap of the backoff and of the Retry-After delay.
+        :param failure_threshold: The consecutive failures that open the breaker of a host.
+        :param reset_timeout: The seconds an open breaker fails fast before a trial request.
+        :param pool_size: The connections kept per host.
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker(
+                    host, self.failure_threshold, self.reset_timeout
+                )
+            return breaker
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def get(
+        self,
+        url: str,
+        parse: Optional[Callable[[requests.Response], Any]] = None,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        breaker_key: Optional[str] = None,
+        **kwargs,
+    ) -> Any:
+        """
+        Sends a GET request.
+        :param url: The url.
+        :param parse: Turns a successful response into the result. Its errors, e.g. on a malformed
+            body, are retried like transient failures, and other 4xx responses raise HTTPError.
+            Without it the response is returned whatever its status.
+        :param timeout: The timeout of each attempt, the client timeout by default.
+        :param retries: The number of retries, the client retries by default.
+        :param breaker_key: The circuit breaker of the request, the host of the url by default. A proxy
+            such as a page reader should use the proxied site, so one bad site cannot open it for all.
+        :param kwargs: Passed to requests, e.g. params and headers.
+        :return: The parsed result, or the response.
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breaker(breaker_key or host)
+        cancel = current_cancel_event()
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        requests_total = metrics.counter("tool_http_requests_total", "Tool HTTP attempts by outcome.")
+
+        error: Optional[BaseException] = None
+        for attempt in range(retries + 1):
+            breaker.allow()
+            delay = None
+            try:
+                response = self.session.get(url, timeout=timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+                outcome = "error"
+            else:
+                if response.status_code in RETRYABLE_STATUS:
+                    error = requests.HTTPError(f"{response.status_code} from {host}", response=response)
+                    outcome = str(response.status_code)
+                    delay = retry_after(response)
+                elif response.status_code >= 400 and parse is not None:
+                    # The upstream is healthy, the request is wrong: no retry
+                    breaker.record_success()
+                    requests_total.inc(host=host, outcome=str(response.status_code))
+                    response.raise_for_status()
+                else:
+                    try:
+                        result = parse(response) if parse is not None else response
+                    except Exception as e:
+                        error = e
+                        outcome = "malformed"
+                    else:
+                        breaker.record_success()
+                        requests_total.inc(host=host, outcome="ok")
+                        return result
+
+            breaker.record_failure()
+            requests_total.inc(host=host, outcome=outcome)
+            if attempt == retries:
+                break
+            delay = min(self.backoff_max, delay) if delay is not None else self.backoff(attempt)
+            logger.warning(
+                "%s failed (%s), retry %d/%d in %.2fs", host, error, attempt + 1, retries, delay
+            )
+            if cancel.wait(delay):
+                raise CancelledError()
+
+        raise RetriesExhaustedError(f"{host} failed after {retries + 1} attempts: {error}") from error
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Returns the state of the circuit breaker of each host.
+        """
+        with self._lock:
+            return {host: breaker.stats() for host, breaker in self.breakers.items()}
+
+    def close(self):
+        self.session.close()
+
+
+class TokenBucket:
+    """
+    Holds up to burst tokens, refilled at rate tokens per second. Not thread safe on its own,
+    RateLimiter serializes the access to its buckets.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per key, e.g. per user, and for all the keys together.
+    A request is admitted only if both buckets hold a token, and then takes one from each.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        global_rate: float = 0.0,
+        global_burst: int = 0,
+        max_keys: int = 10000,
+    ):
+        """
+        :param rate: The tokens refilled per second in the bucket of each key, 0 disables the limit.
+        :param burst: The capacity of the bucket of each key.
+        :param global_rate: The tokens refilled per second in the global bucket, 0 disables the limit.
+        :param global_burst: The capacity of the global bucket.
+        :param max_keys: The buckets kept in memory, the least recently used are dropped first.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.limits = (rate, burst, global_rate, global_burst)
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        # An idle bucket is full again after burst / rate seconds, so it can simply expire
+        self.buckets = TTLCache(maxsize=max_keys, ttl=burst / rate if rate > 0 else 0)
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable) -> Optional[str]:
+        """
+        Takes a token for a request.
+        :param key: The key of the request, e.g. the user id.
+        :return: None if the request is admitted, otherwise the limit it hit: "user" or "global".
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = None
+            if self.rate > 0:
+                bucket = self.buckets.peek(key) or TokenBucket(self.rate, self.burst)
+                if bucket.refill(now) < 1:
+                    return "user"
+            if self.global_bucket is not None and self.global_bucket.refill(now) < 1:
+                return "global"
+            if bucket is not None:
+                bucket.tokens -= 1
+                self.buckets.set(key, bucket)
+            if self.global_bucket is not None:
+                self.global_bucket.tokens -= 1
+            return None
+
+
+class LatencyWindow:
+    """
+    Mean of the latencies observed during the last window seconds.
+    """
+
+    def __init__(self, window: float = 30.0):
+        self.window = window
+        self.samples: Deque[Tuple[float, float]] = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now: float):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+
+    def observe(self, seconds: float):
+        now = time.monotonic()
+        with self._lock:
+            self.samples.append((now, seconds))
+            self._prune(now)
+
+    def mean(self, min_samples: int = 1) -> Optional[float]:
+        """
+        Returns the mean latency in seconds.
+        :param min_samples: The observations needed, so that a single outlier is not taken for a trend.
+        :return: The mean, None with fewer recent observations.
+        """
+        with self._lock:
+            self._prune(time.monotonic())
+            if not self.samples or len(self.samples) < min_samples:
+                return None
+            return sum(seconds for _, seconds in self.samples) / len(self.samples)
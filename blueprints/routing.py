@@ -0,0 +1,175 @@
+from typing import Dict, List, Optional, Tuple
+from collections import Counter
+import math
+import re
+
+# Words too common in queries and tool descriptions to say anything about the tool to use
+STOPWORDS = frozenset(
+    """a an and are as at be by can could do does for from get give how i if in is it
+    its me my of on or please return show tell that the their this to use what when
+    where which who why will with would you your""".split()
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lowercase terms, dropping stopwords and plural endings.
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower().replace("_", " ")):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+            token = token[:-1]
+        terms.append(token)
+    return terms
+
+
+def raw_query_tool(parameter: str):
+    """
+    Marks a tool whose only required parameter can be filled with the raw user message,
+    which allows dispatching it without asking the task model for the parameters.
+    :param parameter: The name of that parameter.
+    """
+
+    def decorator(function):
+        function.__raw_query_parameter__ = parameter
+        return function
+
+    return decorator
+
+
+class RouteDecision:
+    def __init__(
+        self,
+        action: str,
+        candidates: List[Tuple[str, float]],
+        call: Optional[dict] = None,
+    ):
+        # "skip": no tool is needed, "llm": ask the task model, "direct": call the tool without the task model
+        self.action = action
+        self.candidates = candidates
+        self.call = call
+
+    @property
+    def tool_names(self) -> List[str]:
+        return [name for name, _ in self.candidates]
+
+    def to_dict(self) -> dict:
+        return {
+            "action": self.action,
+            "candidates": [[name, round(score, 3)] for name, score in self.candidates],
+            "call": self.call,
+        }
+
+
+class ToolRouter:
+    """
+    Scores the tools against a query with BM25 over their names, descriptions and
+    parameter descriptions, to decide locally whether function calling is needed at all.
+    """
+
+    def __init__(
+        self,
+        specs: List[dict],
+        raw_query_parameters: Optional[Dict[str, str]] = None,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        """
+        :param specs: The tool specs, as returned by get_tools_specs.
+        :param raw_query_parameters: The tools that can be dispatched with the raw user message, mapped to the parameter that receives it.
+        """
+        self.k1 = k1
+        self.b = b
+        self.specs = {spec["name"]: spec for spec in specs}
+        self.raw_query_parameters = raw_query_parameters or {}
+
+        self.documents: Dict[str, Counter] = {}
+        for spec in specs:
+            text = " ".join(
+                [spec["name"], spec.get("description", "")]
+                + [
+                    str(prop.get("description", ""))
+                    for prop in spec["parameters"]["properties"].values()
+                ]
+            )
+            self.documents[spec["name"]] = Counter(tokenize(text))
+
+        self.lengths = {name: sum(terms.values()) for name, terms in self.documents.items()}
+        self.average_length = (
+            sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0.0
+        )
+
+        document_frequency = Counter()
+        for terms in self.documents.values():
+            document_frequency.update(terms.keys())
+        count = len(self.documents)
+        self.idf = {
+            term: math.log(1 + (count - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    def score(self, query: str) -> List[Tuple[str, float]]:
+        """
+        Scores every tool against a query.
+        :param query: The user query.
+        :return: The (tool name, BM25 score) pairs, best first.
+        """
+        terms = [term for term in tokenize(query) if term in self.idf]
+        scores = []
+        for name, document in self.documents.items():
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[name] / (self.average_length or 1))
+            score = 0.0
+            for term in terms:
+                frequency = document.get(term, 0)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + norm)
+            scores.append((name, score))
+        scores.sort(key=lambda item: item[1], reverse=True)
+        return scores
+
+    def direct_call(self, name: str, query: str) -> Optional[dict]:
+        """
+        Returns the call of a tool whose parameters need no model, or None.
+        """
+        required = self.specs[name]["parameters"]["required"]
+        if not required:
+            return {"name": name, "parameters": {}}
+        parameter = self.raw_query_parameters.get(name)
+        if parameter and required == [parameter]:
+            return {"name": name, "parameters": {parameter: query}}
+        return None
+
+    def route(
+        self,
+        query: str,
+        skip_threshold: float,
+        direct_threshold: float,
+        top_k: int,
+    ) -> RouteDecision:
+        """
+        Decides how to handle a query.
+        :param query: The user query.
+        :param skip_threshold: Below this best score no tool is called.
+        :param direct_threshold: From this best score the best tool is called directly, if its parameters need no model.
+        :param top_k: The number of candidate tools sent to the task model otherwise.
+        :return: The routing decision.
+        """
+        scores = self.score(query or "")
+        candidates = scores[: max(1, top_k)]
+        best = candidates[0][1] if candidates else 0.0
+
+        if not candidates or best < skip_threshold:
+            return RouteDecision("skip", candidates)
+
+        if best >= direct_threshold:
+            # Only when the best tool clearly wins over the runner-up
+            runner_up = scores[1][1] if len(scores) > 1 else 0.0
+            call = self.direct_call(candidates[0][0], query)
+            if call is not None and runner_up < best / 2:
+                return RouteDecision("direct", candidates, call)
+
+        return RouteDecision("llm", candidates)
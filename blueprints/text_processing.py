@@ -0,0 +1,295 @@
+from typing import Iterable, List, Optional, Sequence
+from collections import Counter
+from functools import lru_cache
+import re
+import threading
+
+# NLTK resources used by TextNormalizer, as (package, resource path) alternatives.
+# Recent NLTK releases tokenize with punkt_tab, older ones with punkt.
+NLTK_RESOURCES = {
+    "punkt": (("punkt_tab", "tokenizers/punkt_tab"), ("punkt", "tokenizers/punkt")),
+    "stopwords": (("stopwords", "corpora/stopwords"),),
+    "wordnet": (("wordnet", "corpora/wordnet"),),
+}
+
+
+def load_nltk(data_dir: Optional[str] = None):
+    """
+    Imports NLTK and checks, without downloading anything, that the resources used by TextNormalizer are installed.
+    :param data_dir: An optional local nltk_data directory searched before the default locations.
+    :return: The nltk module.
+    """
+    import nltk
+
+    if data_dir and data_dir not in nltk.data.path:
+        nltk.data.path.insert(0, data_dir)
+
+    missing = []
+    for alternatives in NLTK_RESOURCES.values():
+        for _, resource in alternatives:
+            try:
+                nltk.data.find(resource)
+                break
+            except LookupError:
+                continue
+        else:
+            missing.append(alternatives[0][0])
+
+    if missing:
+        raise LookupError(
+            f"Missing NLTK resources: {', '.join(missing)}. Install them with "
+            f"`python -m nltk.downloader -d {data_dir or '<nltk_data dir>'} {' '.join(missing)}`"
+        )
+    return nltk
+
+
+class TextNormalizer:
+    """
+    Tokenizes a text, drops non-alphanumeric tokens and stopwords, lemmatizes
+    the rest and splits the result into sentences.
+
+    The stopword set and the lemmatizer are built once and shared by every call,
+    and lemmas are memoized in a bounded LRU cache.
+    """
+
+    def __init__(
+        self,
+        language: str = "english",
+        lemma_cache_size: int = 65536,
+        data_dir: Optional[str] = None,
+    ):
+        load_nltk(data_dir)
+        from nltk.tokenize import word_tokenize, sent_tokenize
+        from nltk.corpus import stopwords
+        from nltk.stem import WordNetLemmatizer
+
+        self.word_tokenize = word_tokenize
+        self.sent_tokenize = sent_tokenize
+        self.language = language
+        self.stopwords = frozenset(stopwords.words(language))
+        self.lemmatizer = WordNetLemmatizer()
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(self.lemmatizer.lemmatize)
+
+    def tokens(self, text: str) -> List[str]:
+        """
+        Tokenizes a text and keeps the alphanumeric tokens that are not stopwords.
+        :param text: The text to tokenize.
+        :return: The filtered tokens.
+        """
+        stop = self.stopwords
+        return [
+            token
+            for token in self.word_tokenize(text, language=self.language)
+            if token.isalnum() and token not in stop
+        ]
+
+    def normalize(self, text: str) -> List[str]:
+        """
+        Normalizes a single text.
+        :param text: The text to normalize.
+        :return: The sentences of the normalized text.
+        """
+        lemmatize = self.lemmatize
+        formatted_text = " ".join(lemmatize(token) for token in self.tokens(text))
+        return self.sent_tokenize(formatted_text, language=self.language)
+
+    def normalize_sentences(self, text: str) -> List[str]:
+        """
+        Splits a text into lines and sentences first, then normalizes each of them,
+        so that the result keeps one entry per sentence of the original text.
+        :param text: The text to normalize.
+        :return: The normalized non-empty sentences.
+        """
+        lemmatize = self.lemmatize
+        sentences = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            for sentence in self.sent_tokenize(line, language=self.language):
+                normalized = " ".join(lemmatize(token) for token in self.tokens(sentence))
+                if normalized:
+                    sentences.append(normalized)
+        return sentences
+
+    def normalize_batch(self, texts: Iterable[str]) -> List[List[str]]:
+        """
+        Normalizes many texts in one pass, lemmatizing each distinct token only once.
+        :param texts: The texts to normalize.
+        :return: The sentences of each normalized text, in the same order.
+        """
+        documents = [self.tokens(text) for text in texts]
+
+        lemmatize = self.lemmatize
+        lemmas = {token: lemmatize(token) for document in documents for token in document}
+
+        return [
+            self.sent_tokenize(
+                " ".join([lemmas[token] for token in document]), language=self.language
+            )
+            for document in documents
+        ]
+
+    def cache_info(self):
+        return self.lemmatize.cache_info()
+
+
+_normalizer: Optional[TextNormalizer] = None
+_normalizer_lock = threading.Lock()
+
+
+def get_text_normalizer(data_dir: Optional[str] = None) -> TextNormalizer:
+    """
+    Returns the process wide TextNormalizer, importing NLTK and creating it on first use.
+    :param data_dir: An optional local nltk_data directory, used when the normalizer is created.
+    :return: The shared normalizer.
+    """
+    global _normalizer
+    if _normalizer is None:
+        with _normalizer_lock:
+            if _normalizer is None:
+                _normalizer = TextNormalizer(data_dir=data_dir)
+    return _normalizer
+
+
+def normalize_sentences(text: str, data_dir: Optional[str] = None) -> List[str]:
+    """
+    Normalizes a text with the process wide TextNormalizer.
+    Picklable, so that it can run in a worker process.
+    """
+    return get_text_normalizer(data_dir).normalize_sentences(text)
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalizes a query so that near-identical queries compare equal:
+    lowercase, collapsed whitespace and no trailing punctuation.
+    Shared by the cache keys, the decision keys and the speculative call matching.
+    """
+    return " ".join(text.lower().split()).rstrip("?!.,;: ")
+
+
+TERM_PATTERN = re.compile(r"\w+")
+
+
+def terms(text: str) -> List[str]:
+    return TERM_PATTERN.findall(text.lower())
+
+
+def split_long_sentence(sentence: str, max_chars: int) -> List[str]:
+    """
+    Splits a sentence longer than max_chars into word windows of at most max_chars.
+    """
+    if len(sentence) <= max_chars:
+        return [sentence]
+    pieces, current, length = [], [], 0
+    for word in sentence.split():
+        if current and length + len(word) + 1 > max_chars:
+            pieces.append(" ".join(current))
+            current, length = [], 0
+        current.append(word)
+        length += len(word) + 1
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def assemble_context(
+    query: str,
+    pages: Sequence[List[str]],
+    max_chars: int = 6000,
+    max_sentence_chars: int = 400,
+    duplicate_threshold: float = 0.85,
+    k1: float = 1.2,
+    b: float = 0.75,
+    dimensions: int = 2048,
+) -> str:
+    """
+    Picks the sentences of all the pages most relevant to a query, within a character budget.
+
+    Sentences are ranked with BM25 against the query, near-duplicates (cosine similarity of
+    their hashed TF-IDF vectors above duplicate_threshold) are dropped, and the selected
+    sentences are returned in page order.
+
+    :param query: The query, normalized like the sentences.
+    :param pages: The sentences of each page.
+    :param max_chars: The budget of the returned context in characters.
+    :param max_sentence_chars: Longer sentences are split in word windows of this size.
+    :param duplicate_threshold: The similarity above which a sentence is a duplicate of a selected one.
+    :return: The selected sentences, one per line.
+    """
+    import numpy as np
+
+    sentences, positions = [], []
+    for page_index, page in enumerate(pages):
+        for sentence in page:
+            for piece in split_long_sentence(sentence, max_sentence_chars):
+                sentences.append(piece)
+                positions.append((page_index, len(positions)))
+    if not sentences:
+        return ""
+
+    # Sparse term counts as (sentence, term, count) triplets
+    vocabulary = {}
+    rows, columns, counts = [], [], []
+    for row, sentence in enumerate(sentences):
+        for term, count in Counter(terms(sentence)).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            counts.append(count)
+    rows = np.asarray(rows, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.float64)
+
+    n = len(sentences)
+    # Rows are sorted, so the terms of sentence i are in indptr[i]:indptr[i + 1]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=n))))
+    lengths = np.bincount(rows, weights=counts, minlength=n)
+    document_frequency = np.bincount(columns, minlength=len(vocabulary)).astype(np.float64)
+    idf = np.log(1 + (n - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    # BM25 relevance to the query
+    scores = np.zeros(n)
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))
+    for term in set(terms(query)):
+        column = vocabulary.get(term)
+        if column is None:
+            continue
+        mask = columns == column
+        tf = np.bincount(rows[mask], weights=counts[mask], minlength=n)
+        scores += idf[column] * tf * (k1 + 1) / (tf + norm)
+
+    # Best first, ties in page order
+    order = np.lexsort((np.arange(n), -scores))
+
+    # Hashed TF-IDF vectors, L2 normalized, for the near-duplicate check
+    buckets = np.asarray(
+        [hash(term) % dimensions for term in vocabulary], dtype=np.int64
+    )
+    selected, selected_vectors, seen, used = [], [], set(), 0
+    for index in order:
+        sentence = sentences[index]
+        if used + len(sentence) + 1 > max_chars:
+            if used + 1 >= max_chars:
+                break
+            continue
+        key = " ".join(terms(sentence))
+        if not key or key in seen:
+            continue
+
+        span = slice(indptr[index], indptr[index + 1])
+        vector = np.zeros(dimensions)
+        np.add.at(vector, buckets[columns[span]], counts[span] * idf[columns[span]])
+        vector_norm = np.linalg.norm(vector)
+        if vector_norm == 0:
+            continue
+        vector /= vector_norm
+        if selected_vectors and float(np.max(np.asarray(selected_vectors) @ vector)) > duplicate_threshold:
+            continue
+
+        seen.add(key)
+        selected.append(index)
+        selected_vectors.append(vector)
+        used += len(sentence) + 1
+
+    selected.sort(key=lambda index: positions[index])
+    return "\n".join(sentences[index] for index in selected)
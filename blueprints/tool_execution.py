@@ -0,0 +1,367 @@
+from typing import Any, Callable, List, Optional, Sequence
+from concurrent.futures import CancelledError, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import multiprocessing
+import threading
+
+from blueprints.text_processing import normalize_query
+
+logger = logging.getLogger(__name__)
+
+# Set for the duration of a tool call, tools running in threads can poll it to stop early
+_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    "tool_cancel_event", default=None
+)
+
+
+def current_cancel_event() -> threading.Event:
+    """
+    Returns the event set when the running tool call times out or is cancelled,
+    a fresh unset event outside of a tool call.
+    """
+    return _cancel_event.get() or threading.Event()
+
+
+def tool_timeout(seconds: float):
+    """
+    Declares how long a tool may run before its call is abandoned,
+    overriding the TOOL_TIMEOUT valve of the pipeline.
+    :param seconds: The timeout in seconds.
+    """
+
+    def decorator(function):
+        function.__tool_timeout__ = seconds
+        return function
+
+    return decorator
+
+
+def speculative_tool(
+    arguments: Optional[Callable[[str], Optional[dict]]] = None, warm: Sequence[str] = ()
+):
+    """
+    Marks a slow tool that may be started while the task model is still deciding,
+    when the router predicts it. The prefetched result is used only if the model
+    then asks for the same call, otherwise the call is cancelled.
+
+    Example:
+        @speculative_tool(lambda query: {"location": location_from_query(query)}, warm=("unit",))
+        def get_current_weather(self, location: str, unit: str = "fahrenheit") -> str:
+
+    :param arguments: Builds the provisional parameters from the user message, None when it cannot.
+        By default the user message fills the parameter declared with raw_query_tool.
+    :param warm: Parameters that do not change the slow work of the tool, e.g. a unit converted locally.
+        A call differing only in them lets the prefetch finish warming the tool caches, then runs itself.
+    """
+
+    def decorator(function):
+        function.__speculative_arguments__ = arguments
+        function.__speculative_warm__ = tuple(warm)
+        return function
+
+    return decorator
+
+
+def batched_tool(parameter: str, separator: str = "; "):
+    """
+    Marks a tool that accepts several values of one parameter joined by a separator, e.g.
+    several cities fetched with one bulk request. Calls of the tool in the same answer of
+    the task model that differ only in this parameter then run as one call.
+
+    Example:
+        @batched_tool("location")
+        def get_current_weather(self, location: str, unit: str = "fahrenheit") -> str:
+
+    :param parameter: The parameter whose values are joined.
+    :param separator: The separator the tool splits the values on.
+    """
+
+    def decorator(function):
+        function.__batch_parameter__ = (parameter, separator)
+        return function
+
+    return decorator
+
+
+def normalized_arguments(function: Callable, parameters: dict, ignore: Sequence[str] = ()) -> Optional[dict]:
+    """
+    Returns the arguments of a call of a tool with the defaults applied and the strings normalized
+    with normalize_query, None if the parameters do not fit the tool.
+    :param ignore: Parameters left out.
+    """
+    try:
+        bound = inspect.signature(function).bind(**parameters)
+    except TypeError:
+        return None
+    bound.apply_defaults()
+    return {
+        name: normalize_query(value) if isinstance(value, str) else value
+        for name, value in bound.arguments.items()
+        if name not in ignore
+    }
+
+
+def same_call(function: Callable, parameters: dict, other: dict, ignore: Sequence[str] = ()) -> bool:
+    """
+    Tells whether two sets of parameters make the same call of a tool, once the defaults
+    are applied and string arguments are compared regardless of case, spacing and
+    trailing punctuation.
+    :param ignore: Parameters left out of the comparison.
+    """
+    first = normalized_arguments(function, parameters, ignore)
+    return first is not None and first == normalized_arguments(function, other, ignore)
+
+
+def merge_batched_calls(
+    calls: List[dict],
+    resolve: Callable[[str], Optional[Callable]],
+    keep: Optional[Callable[[dict, Callable], bool]] = None,
+) -> List[dict]:
+    """
+    Merges the calls of each tool marked with batched_tool that differ only in its batch parameter.
+    :param calls: The function calls.
+    :param resolve: Returns the tool of a name, None for an unknown tool.
+    :param keep: Tells whether a call must run on its own, e.g. because a speculative call matches it.
+    :return: The calls, merged ones taking the place of the first call of their group.
+    """
+    groups: dict = {}
+    merged: List[Any] = []
+    for call in calls:
+        function = resolve(call["name"])
+        parameter, separator = getattr(function, "__batch_parameter__", (None, None))
+        value = call["parameters"].get(parameter) if parameter else None
+        arguments = normalized_arguments(function, call["parameters"], (parameter,)) if isinstance(value, str) else None
+        if arguments is None or (keep is not None and keep(call, function)):
+            merged.append(call)
+            continue
+        key = (call["name"], json.dumps(arguments, sort_keys=True, default=str))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = {"call": call, "parameter": parameter, "separator": separator, "values": {}}
+            merged.append(key)
+        group["values"].setdefault(normalize_query(value), value)
+
+    result = []
+    for item in merged:
+        if isinstance(item, dict):
+            result.append(item)
+            continue
+        group = groups[item]
+        value = group["separator"].join(group["values"].values())
+        result.append({**group["call"], "parameters": {**group["call"]["parameters"], group["parameter"]: value}})
+    return result
+
+
+def parse_function_calls(content: str) -> List[dict]:
+    """
+    Parses the answer of the task model into a list of function calls.
+
+    Accepts a single { "name": ..., "parameters": ... } object, a list of them, or an
+    object holding the list under "calls". An empty answer means no function.
+    :param content: The answer of the task model.
+    :return: The function calls, each with a name and a parameters dict.
+    """
+    content = content.strip()
+    if not content or content in ('""', "''"):
+        return []
+
+    parsed = json.loads(content)
+    if isinstance(parsed, dict) and "calls" in parsed:
+        parsed = parsed["calls"]
+    if isinstance(parsed, dict):
+        parsed = [parsed]
+    if not isinstance(parsed, list):
+        return []
+
+    calls = []
+    for item in parsed:
+        if isinstance(item, dict) and isinstance(item.get("name"), str) and item["name"]:
+            parameters = item.get("parameters") or {}
+            if isinstance(parameters, dict):
+                calls.append({"name": item["name"], "parameters": parameters})
+    return calls
+
+
+class Speculation:
+    """
+    A tool call started with provisional parameters before the task model answered.
+    """
+
+    def __init__(self, call: dict, task: "asyncio.Task"):
+        """
+        :param call: The provisional call.
+        :param task: The task running it, returning a list with its ToolCallResult.
+        """
+        self.call = call
+        self.task = task
+        self.used = False
+        self.warmed = False
+        self.settled = False
+
+    def matches(self, call: dict, function: Callable, warm: bool = False) -> bool:
+        """
+        Tells whether a call of the task model is the prefetched call, without taking it.
+        :param warm: Whether to also accept a call differing in the speculative_tool(warm=...) parameters.
+        """
+        ignore = getattr(function, "__speculative_warm__", ()) if warm else ()
+        if self.used or call["name"] != self.call["name"] or (warm and not ignore):
+            return False
+        return same_call(function, self.call["parameters"], call["parameters"], ignore)
+
+    def claim(self, call: dict, function: Callable) -> bool:
+        """
+        Takes the prefetched call for a call of the task model, if it is the same call.
+        """
+        if not self.matches(call, function):
+            return False
+        self.used = True
+        return True
+
+    def warms(self, call: dict, function: Callable) -> bool:
+        """
+        Tells whether the prefetched call warms the caches of a call of the task model, that is
+        the same call except for the parameters declared with speculative_tool(warm=...).
+        """
+        if not self.matches(call, function, warm=True):
+            return False
+        self.warmed = True
+        return True
+
+
+class ToolCallResult:
+    def __init__(self, call: dict, result: Any = None, error: Optional[BaseException] = None):
+        self.call = call
+        self.result = result
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and bool(self.result)
+
+
+def format_tool_results(results: List[ToolCallResult]) -> str:
+    """
+    Merges the successful tool results into one context block. A single result is
+    returned as is, several are introduced by the call that produced them.
+    :param results: The results of the tool calls.
+    :return: The context, empty if no call succeeded.
+    """
+    successful = [result for result in results if result.ok]
+    if len(successful) == 1 and len(results) == 1:
+        return str(successful[0].result)
+
+    sections = []
+    for result in successful:
+        parameters = ", ".join(
+            f"{name}={value!r}" for name, value in result.call["parameters"].items()
+        )
+        sections.append(f"## {result.call['name']}({parameters})\n{result.result}")
+    return "\n\n".join(sections)
+
+
+class ToolExecutor:
+    """
+    Runs tools off the event loop: async tools are awaited, sync tools run in a
+    thread pool, and CPU-bound helpers called by the tools run in a process pool.
+    """
+
+    def __init__(self, thread_workers: int = 8, process_workers: int = 0):
+        """
+        :param thread_workers: The number of threads running sync tools.
+        :param process_workers: The number of processes running CPU-bound work, 0 runs it in the calling thread.
+        """
+        self.thread_workers = max(1, thread_workers)
+        self.process_workers = max(0, process_workers)
+        self.thread_pool: Optional[ThreadPoolExecutor] = None
+        self.process_pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def get_thread_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self.thread_pool is None:
+                self.thread_pool = ThreadPoolExecutor(
+                    max_workers=self.thread_workers, thread_name_prefix="tool"
+                )
+            return self.thread_pool
+
+    def get_process_pool(self) -> Optional[ProcessPoolExecutor]:
+        if not self.process_workers:
+            return None
+        with self._lock:
+            if self.process_pool is None:
+                # Forking a process that runs threads can deadlock the child, spawn a clean interpreter instead
+                self.process_pool = ProcessPoolExecutor(
+                    max_workers=self.process_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self.process_pool
+
+    async def run(self, function: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        Runs a tool, awaiting it if it is a coroutine function or in the thread pool otherwise.
+
+        When the call times out or the awaiting task is cancelled, the tool's cancel event is
+        set and a call still queued in the thread pool is dropped.
+        :param function: The tool, or any callable wrapping it.
+        :param timeout: The timeout in seconds, None waits indefinitely.
+        :return: The result of the tool.
+        """
+        cancel = threading.Event()
+        token = _cancel_event.set(cancel)
+        try:
+            if inspect.iscoroutinefunction(function):
+                awaitable = function(*args, **kwargs)
+            else:
+                context = contextvars.copy_context()
+                awaitable = asyncio.get_running_loop().run_in_executor(
+                    self.get_thread_pool(),
+                    partial(context.run, function, *args, **kwargs),
+                )
+            return await asyncio.wait_for(awaitable, timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            cancel.set()
+            raise
+        finally:
+            _cancel_event.reset(token)
+
+    def run_cpu(self, function: Callable, *args, **kwargs) -> Any:
+        """
+        Runs CPU-bound work in the process pool and waits for it. Called from a tool thread.
+        :param function: A picklable module level function.
+        :return: The result of the function.
+        """
+        if current_cancel_event().is_set():
+            raise CancelledError()
+        pool = self.get_process_pool()
+        if pool is None:
+            return function(*args, **kwargs)
+        try:
+            return pool.submit(function, *args, **kwargs).result()
+        except BrokenProcessPool:
+            logger.warning("Tool process pool is broken, restarting it")
+            with self._lock:
+                if self.process_pool is pool:
+                    self.process_pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            return function(*args, **kwargs)
+
+    def shutdown(self, wait: bool = False, cancel_futures: bool = True):
+        """
+        Shuts the pools down, the next calls create new ones.
+        :param wait: Whether to wait for the running calls.
+        :param cancel_futures: Whether to drop the queued calls, whose callers then get a CancelledError.
+            Without it they still run on the old pools.
+        """
+        with self._lock:
+            thread_pool, self.thread_pool = self.thread_pool, None
+            process_pool, self.process_pool = self.process_pool, None
+        if thread_pool is not None:
+            thread_pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+        if process_pool is not None:
+            process_pool.shutdown(wait=wait, cancel_futures=cancel_futures)
@@ -1,35 +1,305 @@
 import os
 import requests
-from typing import Literal, List, Optional
+from typing import Callable, Literal, List, Optional
 from datetime import datetime, timedelta
-from nltk.tokenize import word_tokenize, sent_tokenize
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-import nltk, json
-nltk.download('punkt')
-nltk.download('stopwords')
-nltk.download('wordnet')
+from concurrent.futures import FIRST_COMPLETED, CancelledError, ThreadPoolExecutor, wait
+from functools import partial
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+import contextvars
+import tempfile
+import threading
+import time
+import logging
+import re
 
 from blueprints.function_blueprint import Pipeline as FunctionCallingBlueprint
+from blueprints.text_processing import assemble_context, normalize_query, normalize_sentences
+from blueprints.caching import PersistentCache, SingleFlight, TTLCache, cached_tool
+from blueprints.routing import raw_query_tool
+from blueprints.tool_execution import batched_tool, current_cancel_event, speculative_tool
+from blueprints.metrics import metrics
+from blueprints.resilience import ResilientHTTP
 
-def web_scraper(url):
-    response = requests.get("https://r.jina.ai/" + url)
-    tokens = word_tokenize(response.text)
-    tokens = [token for token in tokens if token.isalnum()]  # Remove non-alphanumeric tokens
-    tokens = [token for token in tokens if token not in stopwords.words('english')]  # Remove stopwords
-    lemmatizer = WordNetLemmatizer()
-    tokens = [lemmatizer.lemmatize(token) for token in tokens]  # Lemmatize tokens
-    formatted_text = ' '.join(tokens)
-    sentences = sent_tokenize(formatted_text)
+logger = logging.getLogger(__name__)
+
+# Version of the scraped page cache entries, bumped when the sentences of a page are built differently
+PAGE_CACHE_VERSION = 2
+
+# Query parameters that only track the visitor and never change the page content
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "ref_src"}
+
+def canonical_url(url: str) -> str:
+    """
+    Normalizes a url so that equivalent urls share the same cache entry.
+    :param url: The url to normalize.
+    :return: The url with lowercase scheme and host, no default port, no fragment and sorted query parameters without tracking parameters.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = f"{host}:{parts.port}"
+    path = parts.path or "/"
+    if len(path) > 1:
+        path = path.rstrip("/")
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not key.lower().startswith("utm_") and key.lower() not in TRACKING_PARAMS
+        )
+    )
+    return urlunsplit((scheme, host, path, query, ""))
+
+LOCATION_PATTERN = re.compile(
+    r"\b(?:in|at|for)\s+([A-Z][\w'-]*(?:[ ,]+[A-Z][\w'-]*)*)"
+)
+
+def location_from_query(query: str) -> Optional[dict]:
+    """
+    Guesses the location of a weather question, the capitalized words after "in", "at" or "for".
+    :param query: The user message.
+    :return: The provisional parameters of get_current_weather, or None if no location is found.
+    """
+    matches = LOCATION_PATTERN.findall(query)
+    if not matches:
+        return None
+    return {"location": matches[-1].strip(" ,")}
+
+def web_scraper(
+    url,
+    timeout=None,
+    nltk_data_dir=None,
+    cache: Optional[PersistentCache] = None,
+    normalize: Optional[Callable[[str], List[str]]] = None,
+    reader_url: str = "https://r.jina.ai/",
+    http: Optional[ResilientHTTP] = None,
+):
+    # Entries of older versions are never served, they expire with the cache TTL
+    key = f"v{PAGE_CACHE_VERSION}:{canonical_url(url)}"
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry["sentences"]
+
+    with metrics.span("scraping"):
+        if http is None:
+            response = requests.get(reader_url + url, timeout=timeout)
+        else:
+            # No retries, they would stretch the fetch timeout of the page, and one breaker
+            # per site rather than one for the reader
+            response = http.get(
+                reader_url + url, timeout=timeout, retries=0, breaker_key=urlsplit(url).netloc
+            )
+    # Split in sentences, remove non-alphanumeric tokens and stopwords and lemmatize.
+    # NLTK is only imported the first time a page is scraped, normalize can move this work to another process.
+    with metrics.span("page_normalization"):
+        if normalize is None:
+            sentences = normalize_sentences(response.text, nltk_data_dir)
+        else:
+            sentences = normalize(response.text)
+
+    if cache is not None and response.ok and sentences and "data null" not in sentences:
+        cache.set(key, {"url": url, "text": response.text, "sentences": sentences})
     return sentences
 
+def fetch_pages(
+    urls: List[str],
+    concurrency: int = 4,
+    timeout: float = 10.0,
+    deadline: float = 20.0,
+    first_n: int = 0,
+    scraper: Callable[..., List[str]] = web_scraper,
+    cancel: Optional[threading.Event] = None,
+) -> List[List[str]]:
+    """
+    Scrapes the given urls concurrently.
+    :param urls: The urls to scrape.
+    :param concurrency: The maximum number of pages fetched at the same time.
+    :param timeout: The timeout in seconds of each page fetch.
+    :param deadline: The overall time in seconds after which the pending fetches are abandoned.
+    :param first_n: Return as soon as this many usable pages are fetched, 0 waits for all of them.
+    :param scraper: The function called with each url and the timeout, web_scraper by default.
+    :param cancel: An event that abandons the pending fetches when set, checked every 0.2 seconds.
+    :return: The sentences of each usable page, in the order of the urls.
+    :raises CancelledError: If the cancel event is set, the pages fetched so far are not returned.
+    """
+    if not urls:
+        return []
+
+    pages = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    # Each fetch runs in a copy of the caller's context, so it sees the cancel event of the tool call
+    futures = {
+        executor.submit(contextvars.copy_context().run, scraper, url, timeout): url for url in urls
+    }
+    pending = set(futures)
+    end = time.monotonic() + deadline
+    try:
+        while pending:
+            if cancel is not None and cancel.is_set():
+                logger.info("Fetch cancelled, got %d of %d pages", len(pages), len(urls))
+                # A partial result must not pass for a complete one, e.g. in the tool cache
+                raise CancelledError()
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                logger.info("Fetch deadline reached, got %d of %d pages", len(pages), len(urls))
+                break
+            done, pending = wait(pending, timeout=min(remaining, 0.2), return_when=FIRST_COMPLETED)
+            for future in done:
+                url = futures[future]
+                try:
+                    sentences = future.result()
+                except Exception as e:
+                    logger.warning("connection error: %s", e)
+                    continue
+                if sentences and "data null" not in sentences:
+                    pages[url] = sentences
+            if first_n and len(pages) >= first_n:
+                break
+    finally:
+        # Stragglers are abandoned and queued fetches are never started
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return [pages[url] for url in urls if url in pages]
+
+def convert_temperature(celsius: float, unit: str) -> float:
+    """
+    Converts a temperature in Celsius to the unit asked by the user, "metric" or "fahrenheit".
+    """
+    if unit == "fahrenheit":
+        return round(celsius * 9 / 5 + 32, 2)
+    return round(celsius, 2)
+
+class WeatherBackend:
+    """
+    Current weather from OpenWeatherMap, always fetched in metric units.
+
+    Observations are cached per city id for a short TTL and serve every unit, resolved
+    city ids are cached for a long one, and the observations of several known cities
+    are refreshed with a single request to the group endpoint.
+    """
+
+    # The group endpoint accepts at most 20 city ids per request
+    GROUP_SIZE = 20
+
+    def __init__(
+        self,
+        observation_ttl: float = 300.0,
+        city_ttl: float = 86400.0,
+        city_cache_size: int = 4096,
+    ):
+        self.cities = TTLCache(maxsize=city_cache_size, ttl=city_ttl)
+        self.observations = TTLCache(maxsize=city_cache_size, ttl=observation_ttl)
+
+    @staticmethod
+    def observation(data: dict) -> dict:
+        return {
+            "name": data.get("name", ""),
+            "description": data["weather"][0]["description"],
+            "celsius": data["main"]["temp"],
+        }
+
+    def current(
+        self, http: ResilientHTTP, api_url: str, api_key: str, locations: List[str]
+    ) -> dict:
+        """
+        Returns the current weather of some locations.
+        :param http: The HTTP client of the tools.
+        :param api_url: The OpenWeatherMap API base url.
+        :param api_key: The OpenWeatherMap API key.
+        :param locations: The locations, as given by the user.
+        :return: The observation of each location, None for the locations that were not found.
+        """
+        keys = {location: normalize_query(location) for location in locations}
+        results, stale = {}, {}
+        for location, key in keys.items():
+            city_id = self.cities.get(key)
+            if city_id is None:
+                continue
+            observation = self.observations.get(city_id)
+            if observation is not None:
+                results[location] = observation
+            else:
+                stale.setdefault(city_id, []).append(location)
+
+        # Known cities: one request for up to GROUP_SIZE of them
+        ids = list(stale)
+        for start in range(0, len(ids), self.GROUP_SIZE):
+            batch = ids[start : start + self.GROUP_SIZE]
+            data = http.get(
+                f"{api_url}/group",
+                parse=lambda response: response.json()["list"],
+                params={"id": ",".join(map(str, batch)), "units": "metric", "appid": api_key},
+            )
+            for item in data:
+                observation = self.observation(item)
+                self.observations.set(item["id"], observation)
+                for location in stale.get(item["id"], []):
+                    results[location] = observation
+
+        # Unknown cities, and known ones missing from the group response, are looked up by name
+        unknown = [location for location in locations if location not in results]
+        if unknown:
+            with ThreadPoolExecutor(max_workers=min(4, len(unknown))) as executor:
+                found = executor.map(partial(self.lookup, http, api_url, api_key), unknown)
+                for location, data in zip(unknown, found):
+                    if data is None:
+                        results[location] = None
+                        continue
+                    observation = self.observation(data)
+                    self.cities.set(keys[location], data["id"])
+                    self.observations.set(data["id"], observation)
+                    results[location] = observation
 
+        return {location: results.get(location) for location in locations}
+
+    def lookup(self, http: ResilientHTTP, api_url: str, api_key: str, location: str) -> Optional[dict]:
+        try:
+            return http.get(
+                f"{api_url}/weather",
+                parse=lambda response: response.json(),
+                params={"q": location, "units": "metric", "appid": api_key},
+            )
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return None
+            raise
+
+    def clear(self):
+        self.cities.clear()
+        self.observations.clear()
 
 class Pipeline(FunctionCallingBlueprint):
     class Valves(FunctionCallingBlueprint.Valves):
         # Add your custom parameters here
         OPENWEATHERMAP_API_KEY: str = ""
         BRAVE_API_KEY: str = ""
+        # Endpoints of the services used by the tools, e.g. to point them to a proxy or to local fakes
+        OPENWEATHERMAP_API_URL: str = "http://api.openweathermap.org/data/2.5"
+        BRAVE_API_URL: str = "https://api.search.brave.com/res/v1/web/search"
+        JINA_READER_URL: str = "https://r.jina.ai/"
+        BRAVE_FETCH_CONCURRENCY: int = 4
+        BRAVE_FETCH_TIMEOUT: float = 10.0
+        BRAVE_FETCH_DEADLINE: float = 20.0
+        # Stop fetching once this many usable pages are available, 0 waits for all of them
+        BRAVE_FIRST_N_PAGES: int = 3
+        # Budget in characters of the search context, filled with the sentences most relevant to the query
+        CONTEXT_MAX_CHARS: int = 6000
+        # Local nltk_data directory, resources are never downloaded at runtime
+        NLTK_DATA_DIR: str = ""
+        # Scraped pages cache, shared by all the workers using the same file. An empty path disables it
+        PAGE_CACHE_PATH: str = ""
+        PAGE_CACHE_TTL: float = 3600.0
+        PAGE_CACHE_MAX_ENTRIES: int = 2000
+        PAGE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+        # Brave search results cache, identical concurrent queries share a single upstream request
+        BRAVE_CACHE_TTL: float = 120.0
+        BRAVE_CACHE_SIZE: int = 256
+        # Weather observations are cached per city for every unit, resolved city ids much longer
+        WEATHER_CACHE_TTL: float = 300.0
+        WEATHER_CITY_CACHE_TTL: float = 86400.0
+        WEATHER_CITY_CACHE_SIZE: int = 4096
         pass
 
     class Tools:
@@ -60,6 +330,10 @@ class Pipeline(FunctionCallingBlueprint):
             current_date = now.strftime("%A, %B %d, %Y")
             return f"Current Date = {current_date}"
 
+        # The unit is converted locally, a prefetch in another unit still warms the weather backend
+        @speculative_tool(location_from_query, warm=("unit",))
+        # One call per city from the task model still makes a single group request for the known ones
+        @batched_tool("location")
         def get_current_weather(
             self,
             location: str,
@@ -67,7 +341,7 @@ class Pipeline(FunctionCallingBlueprint):
         ) -> str:
             """
             Get the current weather for a location. If the location is not found, return an empty string.
-            :param location: The location to get the weather for.
+            :param location: The location to get the weather for. Several locations can be separated by semicolons.
             :param unit: The unit to get the weather in. Default is fahrenheit.
             :return: The current weather for the location.
             """
@@ -77,25 +351,27 @@ class Pipeline(FunctionCallingBlueprint):
             if self.pipeline.valves.OPENWEATHERMAP_API_KEY == "":
                 return "OpenWeatherMap API Key not set, ask the user to set it up."
             else:
-                units = "imperial" if unit == "fahrenheit" else "metric"
-                params = {
-                    "q": location,
-                    "appid": self.pipeline.valves.OPENWEATHERMAP_API_KEY,
-                    "units": units,
-                }
-
-                response = requests.get(
-                    "http://api.openweathermap.org/data/2.5/weather", params=params
+                locations = [name.strip() for name in location.split(";") if name.strip()]
+                # Raises an HTTPError for bad responses
+                observations = self.pipeline.get_weather_backend().current(
+                    self.pipeline.tool_http,
+                    self.pipeline.valves.OPENWEATHERMAP_API_URL,
+                    self.pipeline.valves.OPENWEATHERMAP_API_KEY,
+                    locations,
                 )
-                response.raise_for_status()  # Raises an HTTPError for bad responses
-                data = response.json()
-
-                weather_description = data["weather"][0]["description"]
-                temperature = data["main"]["temp"]
 
-                return f"{location}: {weather_description.capitalize()}, {temperature}°{unit.capitalize()[0]}"
+                symbol = "F" if unit == "fahrenheit" else "C"
+                return "\n".join(
+                    f"{name}: {observation['description'].capitalize()}, "
+                    f"{convert_temperature(observation['celsius'], unit)}°{symbol}"
+                    for name, observation in observations.items()
+                    if observation is not None
+                )
 
 
+        @cached_tool(ttl=300)
+        @speculative_tool()
+        @raw_query_tool("query")
         def bravesearch(
                 self,
                 query: str,
@@ -112,58 +388,40 @@ class Pipeline(FunctionCallingBlueprint):
                 current_date = datetime.today()
                 current_date = current_date.date()
                 month_ago = current_date - timedelta(days=60)
-                api_key = self.pipeline.valves.BRAVE_API_KEY
-                url = 'https://api.search.brave.com/res/v1/web/search'
-                # Set query parameters
-                params = {
-                    "q": query,
-                    "Accept": "application/json"
-                }
-                # Add API key to headers
-                headers = {
-                    "X-Subscription-Token": api_key,
-                }
-                # Make GET request with compressed response
-                response = requests.get(url, params=params, headers=headers, stream=True)
-                data = json.loads(response.text)
-                #print(data)
-                try:
-                    results = data["web"]["results"]
-                except:
-                    check = True
-                    while check:
-                        print("Wrong format in the response, retry the query")
-                        params_new = {
-                            "q": query,
-                            "Accept": "application/json"
-                        }
-                        response = requests.get(url, params=params_new, headers=headers, stream=True)
-                        data = json.loads(response.text)
-                        #print(data)
-                        try:
-                            results = data["web"]["results"]
-                            check = False
-                        except KeyError as e:
-                            print(f"Error: {e}")
+                results = self.pipeline.search_brave(query)
                 href_values = []
                 for result in results:
                     if "url" in result and "page_age" in result and datetime.strptime(result["page_age"], "%Y-%m-%dT%H:%M:%S").date() > month_ago:
                         href_values.append(result["url"])
 
-                contents = []
-                print(href_values)
-                for href in href_values:
-                    print("Scanning: ",href)
-                    try:
-                        contents_1 = web_scraper(href)
-                        if "data null" not in contents_1:
-                            contents = contents_1
-                    except Exception as e:
-                        print (f"connection error: {e}")
-                output = ""
-                for content in contents:
-                    output += content +''
-                return output
+                logger.debug("Pages to scrape: %s", href_values)
+                valves = self.pipeline.valves
+                nltk_data_dir = valves.NLTK_DATA_DIR or None
+                executor = self.pipeline.tool_executor
+                pages = fetch_pages(
+                    href_values,
+                    concurrency=valves.BRAVE_FETCH_CONCURRENCY,
+                    timeout=valves.BRAVE_FETCH_TIMEOUT,
+                    deadline=valves.BRAVE_FETCH_DEADLINE,
+                    first_n=valves.BRAVE_FIRST_N_PAGES,
+                    scraper=partial(
+                        web_scraper,
+                        nltk_data_dir=nltk_data_dir,
+                        cache=self.pipeline.get_page_cache(),
+                        reader_url=valves.JINA_READER_URL,
+                        http=self.pipeline.tool_http,
+                        # Lemmatizing whole pages is CPU-bound, it runs in the tool process pool
+                        normalize=lambda text: executor.run_cpu(
+                            normalize_sentences, text, nltk_data_dir
+                        ),
+                    ),
+                    cancel=current_cancel_event(),
+                )
+                query_terms = normalize_sentences(query, nltk_data_dir)
+                with metrics.span("context_assembly"):
+                    return assemble_context(
+                        " ".join(query_terms), pages, max_chars=valves.CONTEXT_MAX_CHARS
+                    )
 
     def __init__(self):
         super().__init__()
@@ -179,6 +437,120 @@ class Pipeline(FunctionCallingBlueprint):
                 "pipelines": ["*"],  # Connect to all pipelines
                 "OPENWEATHERMAP_API_KEY": os.getenv("OPENWEATHERMAP_API_KEY", ""),
                 "BRAVE_API_KEY": os.getenv("BRAVE_API_KEY", ""),
+                "NLTK_DATA_DIR": os.getenv("NLTK_DATA", ""),
+                "PAGE_CACHE_PATH": os.getenv(
+                    "PAGE_CACHE_PATH",
+                    os.path.join(tempfile.gettempdir(), "webui_pipelines_page_cache.sqlite3"),
+                ),
             },
         )
         self.tools = self.Tools(self)
+        # The blueprint sized the tool HTTP pool before the custom valves existed
+        self.tool_http.close()
+        self.tool_http = self.create_tool_http()
+        self.page_cache: Optional[PersistentCache] = None
+        self.search_cache = TTLCache(
+            maxsize=self.valves.BRAVE_CACHE_SIZE, ttl=self.valves.BRAVE_CACHE_TTL
+        )
+        self.search_flight = SingleFlight()
+        self.weather = WeatherBackend(
+            observation_ttl=self.valves.WEATHER_CACHE_TTL,
+            city_ttl=self.valves.WEATHER_CITY_CACHE_TTL,
+            city_cache_size=self.valves.WEATHER_CITY_CACHE_SIZE,
+        )
+
+    async def on_valves_updated(self):
+        await super().on_valves_updated()
+        # The endpoints or the keys may have changed, results of the old ones must not be served
+        self.weather.clear()
+        self.search_cache.clear()
+
+    def tool_http_pool_size(self) -> int:
+        # Every tool thread may run a search fetching BRAVE_FETCH_CONCURRENCY pages at once
+        return super().tool_http_pool_size() * max(1, self.valves.BRAVE_FETCH_CONCURRENCY)
+
+    def cache_stats(self) -> dict:
+        """
+        Returns the statistics of the caches of the tools: scraped pages, Brave results and
+        coalesced searches, weather cities and observations.
+        """
+        page_cache = self.get_page_cache()
+        return {
+            "page_cache": page_cache.stats() if page_cache is not None else {},
+            "search_cache": self.search_cache.stats(),
+            "search_flight": self.search_flight.stats(),
+            "weather_cities": self.weather.cities.stats(),
+            "weather_observations": self.weather.observations.stats(),
+        }
+
+    def metrics(self) -> dict:
+        return {**super().metrics(), **self.cache_stats()}
+
+    def metrics_text(self) -> str:
+        cache = metrics.gauge("cache_stat", "Statistics of the in-memory caches.")
+        for name, stats in self.cache_stats().items():
+            for stat, value in stats.items():
+                cache.set(value, cache=name, stat=stat)
+        return super().metrics_text()
+
+    def get_page_cache(self) -> Optional[PersistentCache]:
+        """
+        Returns the scraped pages cache configured by the valves, or None if it is disabled.
+        :return: The page cache.
+        """
+        path = self.valves.PAGE_CACHE_PATH
+        if not path:
+            return None
+        if self.page_cache is None or self.page_cache.path != path:
+            self.page_cache = PersistentCache(path)
+        self.page_cache.ttl = self.valves.PAGE_CACHE_TTL
+        self.page_cache.max_entries = self.valves.PAGE_CACHE_MAX_ENTRIES
+        self.page_cache.max_bytes = self.valves.PAGE_CACHE_MAX_BYTES
+        return self.page_cache
+
+    def get_weather_backend(self) -> WeatherBackend:
+        """
+        Returns the weather backend, with the cache settings of the valves.
+        :return: The weather backend.
+        """
+        self.weather.observations.ttl = self.valves.WEATHER_CACHE_TTL
+        self.weather.cities.ttl = self.valves.WEATHER_CITY_CACHE_TTL
+        self.weather.cities.maxsize = self.valves.WEATHER_CITY_CACHE_SIZE
+        self.weather.observations.maxsize = self.valves.WEATHER_CITY_CACHE_SIZE
+        return self.weather
+
+    def search_brave(self, query: str) -> List[dict]:
+        """
+        Returns the Brave web results of a query, from the cache when possible.
+        Concurrent identical queries are coalesced into a single upstream request.
+        :param query: The search query.
+        :return: The web results of the Brave search API.
+        """
+        key = normalize_query(query)
+        self.search_cache.maxsize = self.valves.BRAVE_CACHE_SIZE
+        results = self.search_cache.get(key)
+        if results is not None:
+            return results
+
+        def fetch():
+            # A concurrent leader may have filled the cache while we were waiting for the lock
+            results = self.search_cache.peek(key)
+            if results is None:
+                with metrics.span("brave_search"):
+                    results = self._request_brave(query)
+                self.search_cache.set(key, results, ttl=self.valves.BRAVE_CACHE_TTL)
+            return results
+
+        return self.search_flight.do(key, fetch)
+
+    def _request_brave(self, query: str) -> List[dict]:
+        # A malformed answer is retried with backoff like a failed request, within the retry budget
+        return self.tool_http.get(
+            self.valves.BRAVE_API_URL,
+            parse=lambda response: response.json()["web"]["results"],
+            params={"q": query},
+            headers={
+                "Accept": "application/json",
+                "X-Subscription-Token": self.valves.BRAVE_API_KEY,
+            },
+        )
@@ -7,11 +7,219 @@ version: 0.1.0
 This module defines a Pipe class that utilizes an N8N workflow for an Agent
 """
 
-from typing import Optional, Callable, Awaitable
+from typing import Optional, Callable, Awaitable, AsyncGenerator, Deque, Union
+from collections import deque
+from contextlib import asynccontextmanager
 from pydantic import BaseModel, Field
 import os
 import time
-import requests
+import asyncio
+import uuid
+import json
+import httpx
+
+
+class StatusEmitter:
+    """
+    Emits the status events of one request, throttled to one every emit_interval seconds.
+    """
+
+    def __init__(
+        self,
+        __event_emitter__: Optional[Callable[[dict], Awaitable[None]]],
+        enabled: bool,
+        emit_interval: float,
+    ):
+        self.event_emitter = __event_emitter__
+        self.enabled = enabled
+        self.emit_interval = emit_interval
+        self.last_emit_time = 0
+
+    async def __call__(self, level: str, message: str, done: bool, force: bool = False):
+        current_time = time.time()
+        if (
+            self.event_emitter
+            and self.enabled
+            and (
+                current_time - self.last_emit_time >= self.emit_interval
+                or done
+                or force
+            )
+        ):
+            await self.event_emitter(
+                {
+                    "type": "status",
+                    "data": {
+                        "status": "complete" if done else "in_progress",
+                        "level": level,
+                        "description": message,
+                        "done": done,
+                    },
+                }
+            )
+            self.last_emit_time = current_time
+
+    async def heartbeat(self, message: str):
+        """Emits a progress status every emit_interval seconds until cancelled."""
+        started = time.time()
+        while True:
+            await asyncio.sleep(max(self.emit_interval, 0.1))
+            await self(
+                "info", f"{message} ({time.time() - started:.0f}s)", False
+            )
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Bounded FIFO queue in front of n8n: at most `limit` requests run at the same time,
+    at most `max_queue` wait for a slot and none waits longer than `queue_timeout`.
+    Requests arriving when the queue is full are rejected immediately.
+    """
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.wait_times: Deque[float] = deque(maxlen=1000)
+
+    def configure(self, limit: int, max_queue: int, queue_timeout: float):
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self._dispatch()
+
+    def _dispatch(self):
+        # Hand the free slots over to the oldest waiters
+        while self.waiters and self.in_flight < self.limit:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(True)
+
+    def _record(self, wait: float):
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.wait_times.append(wait)
+
+    async def acquire(
+        self,
+        on_wait: Optional[Callable[[int, int], Awaitable[None]]] = None,
+        poll_interval: float = 1.0,
+    ):
+        """
+        Waits for a slot.
+        :param on_wait: Called with the queue position and depth whenever the position changes.
+        :param poll_interval: Seconds between two position checks.
+        :raises AdmissionError: If the queue is full or the wait exceeds queue_timeout.
+        """
+        started = time.monotonic()
+        if self.in_flight < self.limit and not self.waiters:
+            self.in_flight += 1
+            self._record(0.0)
+            return
+
+        if len(self.waiters) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionError(
+                f"N8N is busy: {self.in_flight} requests running and {len(self.waiters)} queued, retry later"
+            )
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        deadline = started + self.queue_timeout
+        last_position = None
+        try:
+            while not waiter.done():
+                position = self.waiters.index(waiter) + 1
+                if on_wait is not None and position != last_position:
+                    last_position = position
+                    await on_wait(position, len(self.waiters))
+                    continue
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timed_out += 1
+                    raise AdmissionError(
+                        f"N8N is busy: no slot freed up within {self.queue_timeout:.0f}s, retry later"
+                    )
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(waiter), timeout=min(remaining, poll_interval)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted while we were giving up, hand it over
+                self.release()
+            else:
+                waiter.cancel()
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            raise
+
+        self._record(time.monotonic() - started)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, on_wait=None, poll_interval: float = 1.0):
+        await self.acquire(on_wait, poll_interval)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_times)
+
+        def percentile(q: float) -> float:
+            return waits[min(len(waits) - 1, int(q * len(waits)))] if waits else 0.0
+
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_avg": self.total_wait / self.admitted if self.admitted else 0.0,
+            "wait_max": self.max_wait,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+        }
+
+
+def stream_chunk(chunk_id: str, model: str, content: str, finish_reason: Optional[str] = None) -> dict:
+    """Builds an OpenAI chat.completion.chunk carrying a piece of the response."""
+    return {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"content": content} if content else {},
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
 
 
 class Pipe:
@@ -28,42 +236,183 @@ class Pipe:
         enable_status_indicator: bool = Field(
             default=True, description="Enable or disable status indicator emissions"
         )
+        enable_streaming: bool = Field(
+            default=False,
+            description="Forward the n8n response as it arrives, requires a workflow that streams its response",
+        )
+        connect_timeout: float = Field(
+            default=10.0, description="Seconds to wait for a connection to n8n"
+        )
+        read_timeout: float = Field(
+            default=300.0,
+            description="Seconds to wait for the n8n response, or between two streamed chunks",
+        )
+        max_in_flight: int = Field(
+            default=8, description="Maximum number of concurrent requests to n8n"
+        )
+        max_queue_depth: int = Field(
+            default=32,
+            description="Maximum number of requests waiting for a free slot, further requests are rejected",
+        )
+        queue_timeout: float = Field(
+            default=60.0, description="Maximum seconds a request waits in the queue"
+        )
 
     def __init__(self):
         self.type = "pipe"
         self.id = "n8n_pipe"
         self.name = "N8N Pipe"
         self.valves = self.Valves()
-        self.last_emit_time = 0
+        self.http_client: Optional[httpx.AsyncClient] = None
+        self.admission = AdmissionController(
+            self.valves.max_in_flight,
+            self.valves.max_queue_depth,
+            self.valves.queue_timeout,
+        )
         pass
 
-    async def emit_status(
-        self,
-        __event_emitter__: Callable[[dict], Awaitable[None]],
-        level: str,
-        message: str,
-        done: bool,
-    ):
-        current_time = time.time()
-        if (
-            __event_emitter__
-            and self.valves.enable_status_indicator
-            and (
-                current_time - self.last_emit_time >= self.valves.emit_interval or done
+    def get_http_client(self) -> httpx.AsyncClient:
+        """Returns the pooled keep-alive HTTP client shared by all requests."""
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30.0)
             )
-        ):
-            await __event_emitter__(
-                {
-                    "type": "status",
-                    "data": {
-                        "status": "complete" if done else "in_progress",
-                        "level": level,
-                        "description": message,
-                        "done": done,
-                    },
-                }
+        return self.http_client
+
+    def admit(self, status: StatusEmitter):
+        """
+        Returns the context manager holding one of the max_in_flight slots to n8n,
+        reporting the queue position of the request while it waits.
+        """
+        self.admission.configure(
+            self.valves.max_in_flight,
+            self.valves.max_queue_depth,
+            self.valves.queue_timeout,
+        )
+
+        async def on_wait(position: int, depth: int):
+            await status(
+                "info", f"Waiting in queue, position {position} of {depth}...", False, force=True
             )
-            self.last_emit_time = current_time
+
+        return self.admission.slot(on_wait, poll_interval=min(1.0, self.valves.emit_interval))
+
+    def metrics(self) -> dict:
+        """Returns the queue depth, admission counters and queue wait times."""
+        return self.admission.stats()
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(
+            self.valves.read_timeout, connect=self.valves.connect_timeout
+        )
+
+    async def on_shutdown(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+
+    def stream_content(self, event) -> str:
+        """
+        Extracts the text carried by one line of a streamed n8n response.
+        n8n streams JSON lines typed begin, item, end or error; a workflow answering
+        in one piece sends a single object holding the response field.
+        """
+        if isinstance(event, list):
+            return "".join(self.stream_content(item) for item in event)
+        if not isinstance(event, dict):
+            return ""
+        if "type" in event:
+            if event["type"] == "item":
+                return event.get("content") or ""
+            if event["type"] == "error":
+                raise Exception(f"Error: {event.get('content') or event}")
+            return ""
+        return event.get(self.valves.response_field) or ""
+
+    async def stream_response(
+        self,
+        body: dict,
+        payload: dict,
+        headers: dict,
+        status: StatusEmitter,
+    ) -> AsyncGenerator[dict, None]:
+        chunk_id = f"{self.id}-{uuid.uuid4()}"
+        response_text = ""
+        heartbeat = None
+        try:
+            async with self.admit(status):
+                heartbeat = asyncio.create_task(status.heartbeat("Waiting for N8N Workflow..."))
+                async with self.get_http_client().stream(
+                    "POST",
+                    self.valves.n8n_url,
+                    json=payload,
+                    headers=headers,
+                    timeout=self.timeout(),
+                ) as response:
+                    if response.status_code != 200:
+                        text = (await response.aread()).decode(errors="replace")
+                        raise Exception(f"Error: {response.status_code} - {text}")
+
+                    if response.headers.get("content-type", "").startswith("text/"):
+                        # Plain chunked text, forwarded as is
+                        async for text in response.aiter_text():
+                            if text:
+                                heartbeat.cancel()
+                                response_text += text
+                                yield stream_chunk(chunk_id, self.id, text)
+                    else:
+                        # JSON lines, lines that are not a whole JSON document are
+                        # parts of a pretty printed single-shot response
+                        pending = []
+                        async for line in response.aiter_lines():
+                            if not line.strip():
+                                continue
+                            try:
+                                event = json.loads(line)
+                            except ValueError:
+                                pending.append(line)
+                                continue
+                            text = self.stream_content(event)
+                            if text:
+                                heartbeat.cancel()
+                                response_text += text
+                                yield stream_chunk(chunk_id, self.id, text)
+                        if pending:
+                            text = self.stream_content(json.loads("\n".join(pending)))
+                            if text:
+                                response_text += text
+                                yield stream_chunk(chunk_id, self.id, text)
+
+            heartbeat.cancel()
+            yield stream_chunk(chunk_id, self.id, "", "stop")
+            body["messages"].append({"role": "assistant", "content": response_text})
+            await status("info", "Complete", True)
+        except Exception as e:
+            await status(
+                "error",
+                f"Error during sequence execution: {str(e)}",
+                True,
+            )
+            yield stream_chunk(chunk_id, self.id, f"Error: {str(e)}", "stop")
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+    async def call_n8n(self, payload: dict, headers: dict, status: StatusEmitter) -> str:
+        async with self.admit(status):
+            heartbeat = asyncio.create_task(status.heartbeat("Waiting for N8N Workflow..."))
+            try:
+                response = await self.get_http_client().post(
+                    self.valves.n8n_url,
+                    json=payload,
+                    headers=headers,
+                    timeout=self.timeout(),
+                )
+            finally:
+                heartbeat.cancel()
+        if response.status_code == 200:
+            return response.json()[self.valves.response_field]
+        raise Exception(f"Error: {response.status_code} - {response.text}")
 
     async def pipe(
         self,
@@ -71,10 +420,14 @@ class Pipe:
         __user__: Optional[dict] = None,
         __event_emitter__: Callable[[dict], Awaitable[None]] = None,
         __event_call__: Callable[[dict], Awaitable[dict]] = None,
-    ) -> Optional[dict]:
-        await self.emit_status(
-            __event_emitter__, "info", "/Calling N8N Workflow...", False
+    ) -> Union[dict, str, AsyncGenerator[dict, None], None]:
+        # Status throttling state belongs to this request only
+        status = StatusEmitter(
+            __event_emitter__,
+            self.valves.enable_status_indicator,
+            self.valves.emit_interval,
         )
+        await status("info", "/Calling N8N Workflow...", False)
 
         messages = body.get("messages", [])
 
@@ -91,19 +444,14 @@ class Pipe:
                 }
                 payload = {"sessionId": f"{__user__['id']} - {messages[0]['content'].split('Prompt: ')[-1][:100]}"}
                 payload[self.valves.input_field] = question
-                response = requests.post(
-                    self.valves.n8n_url, json=payload, headers=headers
-                )
-                if response.status_code == 200:
-                    n8n_response = response.json()[self.valves.response_field]
-                else:
-                    raise Exception(f"Error: {response.status_code} - {response.text}")
+                if self.valves.enable_streaming and body.get("stream", True):
+                    return self.stream_response(body, payload, headers, status)
+                n8n_response = await self.call_n8n(payload, headers, status)
 
                 # Set assitant message with chain reply
                 body["messages"].append({"role": "assistant", "content": n8n_response})
             except Exception as e:
-                await self.emit_status(
-                    __event_emitter__,
+                await status(
                     "error",
                     f"Error during sequence execution: {str(e)}",
                     True,
@@ -111,8 +459,7 @@ class Pipe:
                 return {"error": str(e)}
         # If no message is available alert user
         else:
-            await self.emit_status(
-                __event_emitter__,
+            await status(
                 "error",
                 "No messages found in the request body",
                 True,
@@ -124,5 +471,5 @@ class Pipe:
                 }
             )
 
-        await self.emit_status(__event_emitter__, "info", "Complete", True)
+        await status("info", "Complete", True)
         return n8n_response